@@ -0,0 +1,199 @@
+"""
+asyncio download engine for bulk downloads.
+Downloaders are only used for building requests and parsing responses, HTTP goes through one aiohttp session
+so connections are kept alive and concurrency can be limited in total and per host.
+"""
+import asyncio
+import contextlib
+import functools
+import queue
+import threading
+
+import aiohttp
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from config import load_config
+from downloaders import CHUNK_SIZE, DownloaderManager, GelbooruAPIParser, ImageDownloader, ImageDownloaderException, ImageInfo, \
+    PartialFile, UpvoteQueue
+from main_functions import SeriesScheduler, canonical_url, name_image, plan_url_jobs, queue_consumer
+
+__author__ = 'Chronoes'
+
+config = load_config()
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_HOST_CONCURRENCY = 2
+# Threads writing downloaded files to disk
+FILE_WORKERS = 4
+
+
+class HostLimits:
+    """Limits number of concurrent requests in total and per host, subdomains count towards their parent host"""
+    def __init__(self, concurrency: int, per_host: dict, host_default: int):
+        self.total = asyncio.Semaphore(concurrency)
+        self.per_host = per_host
+        self.host_default = host_default
+        self.hosts = {}
+
+    def _host_semaphore(self, url):
+        hostname = urlparse(url).hostname or ''
+        for host, limit in self.per_host.items():
+            if hostname == host or hostname.endswith('.' + host):
+                break
+        else:
+            host, limit = hostname, self.host_default
+        if host not in self.hosts:
+            self.hosts[host] = asyncio.Semaphore(limit)
+        return self.hosts[host]
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, url):
+        # Wait for the host first, so requests to a busy host do not hold up the global slots
+        async with self._host_semaphore(url):
+            async with self.total:
+                yield
+
+
+async def fetch_text(session: aiohttp.ClientSession, limits: HostLimits, url, params=None):
+    async with limits.acquire(url):
+        async with session.get(url, params=params) as resp:
+            return await resp.text()
+
+
+async def download_image(session: aiohttp.ClientSession, limits: HostLimits, downloader: ImageDownloader, link, directory,
+        file_executor: ThreadPoolExecutor=None):
+    """Writes and syncs the file in file_executor, so disk I/O does not hold up the other downloads on the loop"""
+    loop = asyncio.get_running_loop()
+    async with limits.acquire(link):
+        async with session.get(link, headers=downloader.download_headers()) as resp:
+            if resp.status >= 400:
+                raise ImageDownloaderException('{}: Could not download {} ({})'.format(downloader, link, resp.status))
+            partial = await loop.run_in_executor(file_executor, PartialFile, directory)
+            try:
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    await loop.run_in_executor(file_executor, partial.write, chunk)
+                await loop.run_in_executor(file_executor, partial.close)
+            except BaseException:
+                partial.discard()
+                raise
+    return partial.path, partial.content_hash()
+
+
+async def get_image(session: aiohttp.ClientSession, limits: HostLimits, downloader: ImageDownloader, group: str,
+        redownload=False, custom_name=None, skip_data=False, parent=None, upvotes: UpvoteQueue=None,
+        file_executor: ThreadPoolExecutor=None):
+    if group not in config['groups']:
+        return ('{}: No directory configured for group {}'.format(downloader, group), downloader.canonical_url())
+    try:
+        info = downloader.prefetched_info()
+        if info is None:
+            url, params = downloader.info_request()
+            info = downloader.parse_image_info(await fetch_text(session, limits, url, params))
+        if upvotes is not None:
+            upvotes.put(downloader)
+
+        img_info = ImageInfo(info['link'], downloader.canonical_url(), info['tags'], group=group, downloader=downloader,
+            parent=parent)
+        # Looks up the filename in the database, which would block the loop
+        img_info = await asyncio.get_running_loop().run_in_executor(file_executor,
+            functools.partial(name_image, img_info, redownload=redownload, custom_name=custom_name))
+        if type(img_info) != tuple and not skip_data:
+            img_info.path, img_info.content_hash = await download_image(session, limits, downloader, info['link'],
+                config['groups'][group], file_executor=file_executor)
+    except ImageDownloaderException as e:
+        return (str(e), downloader.canonical_url())
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return ('{}: Request for {} failed: {!r}'.format(downloader, downloader.url, e), downloader.canonical_url())
+    return img_info
+
+
+async def prefetch(session: aiohttp.ClientSession, limits: HostLimits, manager: DownloaderManager, urls):
+    """Batched metadata requests of DownloaderManager.prefetch, made through the aiohttp session"""
+    for ids in manager.prefetch_batches(urls):
+        page = 0
+        while True:
+            url, params = manager.prefetch_request(ids, page)
+            try:
+                more = manager.store_prefetched(ids, await fetch_text(session, limits, url, params))
+            except (ImageDownloaderException, aiohttp.ClientError, asyncio.TimeoutError):
+                break
+            if not more:
+                break
+            page += 1
+
+
+async def download_all(urls: list, image_queue: queue.Queue, scheduler: SeriesScheduler, **kwargs):
+    download_config = config.get('download', {})
+    concurrency = download_config.get('concurrency', DEFAULT_CONCURRENCY)
+    limits = HostLimits(concurrency, download_config.get('per_host', {}),
+        download_config.get('per_host_default', DEFAULT_HOST_CONCURRENCY))
+    manager = DownloaderManager()
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=0)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    loop = asyncio.get_running_loop()
+    jobs = asyncio.Queue(concurrency * 2)
+
+    # Separate from the default executor, whose threads can all be blocked on the full results queue
+    file_executor = ThreadPoolExecutor(FILE_WORKERS, thread_name_prefix='file-io')
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def download(group, url, parent):
+            try:
+                downloader = manager.determine_downloader(url)
+                return await get_image(session, limits, downloader, group, parent=parent, file_executor=file_executor,
+                    **kwargs)
+            except (NotImplementedError, ImageDownloaderException) as e:
+                # URLs that the downloader cannot get an ID from fail already when building the canonical URL
+                return (str(e), url)
+            except Exception as e:
+                # Unexpected page contents, disk errors and the like fail only this URL, not the whole run
+                return ('Downloading {} failed: {!r}'.format(url, e), canonical_url(manager, url))
+
+        async def worker():
+            while True:
+                job = await jobs.get()
+                if job is None:
+                    return
+                result = await download(*job)
+                # Blocks while the results queue is full, so a slow consumer holds back downloading
+                await loop.run_in_executor(None, image_queue.put, result)
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            new_jobs, known = plan_url_jobs(urls, manager, scheduler, redownload=kwargs.get('redownload', False))
+            for result in known:
+                await loop.run_in_executor(None, image_queue.put, result)
+            for start in range(0, len(new_jobs), GelbooruAPIParser.batch_size):
+                jobs_chunk = new_jobs[start:start + GelbooruAPIParser.batch_size]
+                await prefetch(session, limits, manager, (url for _, url, _ in jobs_chunk))
+                for job in jobs_chunk:
+                    await jobs.put(job)
+            for _ in workers:
+                await jobs.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            file_executor.shutdown()
+
+
+def get_image_bulk(urls: list, results_callback, **kwargs):
+    url_count = sum(1 for _, url in urls if url.startswith('http'))
+
+    image_queue = queue.Queue(config.get('download', {}).get('queue_size', DEFAULT_CONCURRENCY))
+    scheduler = SeriesScheduler()
+    consumer = threading.Thread(target=queue_consumer, args=(image_queue, url_count, results_callback, scheduler))
+    consumer.start()
+
+    upvotes = UpvoteQueue() if kwargs.pop('upvote', True) else None
+    try:
+        asyncio.run(download_all(urls, image_queue, scheduler, upvotes=upvotes, **kwargs))
+    finally:
+        # The consumer is always shut down, so an error here does not leave the process hanging
+        image_queue.put(None)
+        consumer.join()
+    if upvotes is not None:
+        upvotes.flush()
@@ -0,0 +1,166 @@
+"""
+Local stand-in for the booru sites that downloaders.py parses, so downloads can be benchmarked without the network.
+Serves Gelbooru dapi JSON, Gelbooru, Konachan and Yande.re post pages, upvotes and image files. Every post ID exists
+and its tags and file are derived from the ID, IDs from MISSING_ID up return 404.
+
+Post URLs are http://HOST:PORT/<site>/..., with site being gelbooru.com, konachan.com or yande.re, e.g.
+http://127.0.0.1:8765/konachan.com/post/show/123 and http://127.0.0.1:8765/gelbooru.com/index.php?page=post&s=view&id=123
+Gelbooru API and upvote requests go to http://HOST:PORT/gelbooru.com/index.php.
+
+Usage: python benchmarks/booru_server.py [--port 8765] [--delay SECONDS] [--file-size BYTES]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+
+__author__ = 'Chronoes'
+
+MISSING_ID = 10 ** 9
+VOCABULARY_SIZE = 20000
+TAGS_PER_POST = 15
+# Real post pages are mostly navigation, comments and scripts around the few elements that are parsed
+FILLER_LINKS = 300
+DAPI_LIMIT = 100
+
+
+class BooruHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0
+    file_size = 256 * 1024
+    sampler = None
+    sampler_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status: int, body=b'', content_type='text/html; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def base(self) -> str:
+        return 'http://{}'.format(self.headers['Host'])
+
+    @classmethod
+    def post_tags(cls, post_id: int) -> list:
+        """Tags of a post are always the same, as the sampler is seeded with its ID"""
+        with cls.sampler_lock:
+            if cls.sampler is None:
+                BooruHandler.sampler = common.TagSampler(VOCABULARY_SIZE)
+            cls.sampler.random.seed(post_id)
+            return [common.tag_name(rank) for rank in sorted(cls.sampler.sample(TAGS_PER_POST))]
+
+    def file_url(self, site: str, post_id: int) -> str:
+        return '{}/files/{}/{:08d}.jpg'.format(self.base(), site, post_id)
+
+    def do_GET(self):
+        if self.delay:
+            time.sleep(self.delay)
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        match = re.fullmatch(r'/files/([a-z.]+)/(\d+)\.jpg', url.path)
+        if match:
+            return self.send_file(int(match.group(2)))
+        match = re.fullmatch(r'/(konachan\.com|yande\.re)/post/show/(\d+)', url.path)
+        if match:
+            return self.send_konachan_post(match.group(1), int(match.group(2)))
+        if url.path == '/gelbooru.com/index.php':
+            if query.get('page') == 'dapi':
+                return self.send_dapi(query)
+            if query.get('page') == 'post' and query.get('s') == 'vote':
+                return self.send(200, b'1', 'text/plain')
+            if query.get('page') == 'post' and query.get('s') == 'view' and query.get('id', '').isdigit():
+                return self.send_gelbooru_post(int(query['id']))
+        self.send(404)
+
+    def send_file(self, post_id: int):
+        if post_id >= MISSING_ID:
+            return self.send(404)
+        block = '{:08d}'.format(post_id).encode()
+        self.send(200, (block * (self.file_size // len(block) + 1))[:self.file_size], 'image/jpeg')
+
+    def filler(self) -> str:
+        return ''.join('<li><a href="/wiki/{0}">{0}</a></li>'.format(common.tag_name(i)) for i in range(FILLER_LINKS))
+
+    def send_konachan_post(self, site: str, post_id: int):
+        if post_id >= MISSING_ID:
+            return self.send(404)
+        body = '''<!DOCTYPE html><html><head><title>Post {id}</title><script>var post = {{}};</script></head>
+<body><div id="header"><ul>{filler}</ul></div>
+<div class="content"><img id="image" alt="{tags}" src="{base}/sample/{id}.jpg" width="1500" height="1000">
+<ul><li><a class="original-file-unchanged" id="highres" href="{file}">Download larger version</a></li></ul></div>
+<div id="comments">{filler}</div></body></html>'''.format(
+            id=post_id, tags=' '.join(self.post_tags(post_id)), base=self.base(), file=self.file_url(site, post_id),
+            filler=self.filler())
+        self.send(200, body.encode())
+
+    def send_gelbooru_post(self, post_id: int):
+        if post_id >= MISSING_ID:
+            return self.send(404)
+        body = '''<!DOCTYPE html><html><head><title>Post {id}</title></head>
+<body><ul id="tag-list">{filler}</ul>
+<section class="image-container"><img id="image" alt="{tags}" src="{base}/sample/{id}.jpg"></section>
+<ul><li><a href="{file}" target="_blank" rel="noopener">Original image</a></li></ul>
+<div id="comments">{filler}</div></body></html>'''.format(
+            id=post_id, tags=' '.join(self.post_tags(post_id)), base=self.base(),
+            file=self.file_url('gelbooru.com', post_id), filler=self.filler())
+        self.send(200, body.encode())
+
+    def dapi_post(self, post_id: int) -> dict:
+        return {'id': post_id, 'tags': ' '.join(self.post_tags(post_id)), 'file_url': self.file_url('gelbooru.com', post_id)}
+
+    def send_dapi(self, query: dict):
+        """Posts by id, or by id: terms in tags, either alone or as an {id:1 ~ id:2} group, paged by limit and pid"""
+        if 'id' in query:
+            ids = [int(query['id'])] if query['id'].isdigit() else []
+        else:
+            ids = sorted(set(int(post_id) for post_id in re.findall(r'id:(\d+)', query.get('tags', ''))), reverse=True)
+            limit = min(int(query.get('limit', DAPI_LIMIT)), DAPI_LIMIT)
+            page = int(query.get('pid', 0))
+            ids = ids[page * limit:(page + 1) * limit]
+        posts = [self.dapi_post(post_id) for post_id in ids if post_id < MISSING_ID]
+        body = {'@attributes': {'limit': DAPI_LIMIT, 'offset': 0, 'count': len(posts)}}
+        if posts:
+            body['post'] = posts
+        self.send(200, json.dumps(body).encode(), 'application/json')
+
+
+def start_server(port=0, delay=0, file_size=None):
+    """Starts server in a background thread, returns the server and its base URL"""
+    handler = type('Handler', (BooruHandler,), {'delay': delay, 'file_size': file_size or BooruHandler.file_size})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve stand-in booru pages for benchmarks.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=0, help='Seconds added to every response')
+    parser.add_argument('--file-size', type=int, default=BooruHandler.file_size)
+    args = parser.parse_args()
+
+    server, base_url = start_server(args.port, args.delay, args.file_size)
+    print('Serving on {}'.format(base_url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
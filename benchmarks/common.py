@@ -0,0 +1,62 @@
+"""
+Shared setup for benchmarks.
+Modules of the project read their configuration when imported, so setup() has to run before any of them is imported.
+"""
+import json
+import os
+import random
+import sys
+
+from itertools import accumulate
+
+__author__ = 'Chronoes'
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUPS = ('bench_a', 'bench_b', 'bench_c')
+# Booru tag frequencies follow a power law, a few tags are on most posts and most tags are on a handful
+ZIPF_EXPONENT = 1.1
+
+
+def setup(workdir: str, database_path: str, **overrides) -> dict:
+    """Writes config for a benchmark library in workdir and points the project at it, returns the config"""
+    os.makedirs(workdir, exist_ok=True)
+    config = {
+        'groups': {group: os.path.join(workdir, 'files', group) for group in GROUPS},
+        'database': {'type': 'sqlite', 'path': os.path.abspath(database_path)},
+        # Upvotes are rate limited for the real sites, the stand-in takes them as fast as they come
+        'download': {'engine': 'threads', 'upvote_rate': 1000},
+        'search': {'engine': 'sqlite'},
+        'thumbnails': {'path': os.path.join(workdir, 'cache', 'thumbnails')},
+        'fs_index': {'path': os.path.join(workdir, 'cache', 'fs_index')},
+        'credentials': {'gelbooru': {'api_key': 'bench', 'user_id': 'bench'}},
+    }
+    for section, values in overrides.items():
+        config.setdefault(section, {}).update(values)
+    for directory in config['groups'].values():
+        os.makedirs(directory, exist_ok=True)
+
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    os.environ['CONFIG_PATH'] = config_path
+
+    # Project is imported both as top level modules and as the imagedb package
+    for path in (REPO_PATH, os.path.dirname(REPO_PATH)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    return config
+
+
+class TagSampler:
+    """Draws tag ranks from a Zipf distribution over a vocabulary of the given size"""
+    def __init__(self, vocabulary_size: int, seed=None):
+        self.random = random.Random(seed)
+        self.ranks = range(vocabulary_size)
+        self.cum_weights = list(accumulate(1 / (rank + 1) ** ZIPF_EXPONENT for rank in self.ranks))
+
+    def sample(self, count: int) -> set:
+        return set(self.random.choices(self.ranks, cum_weights=self.cum_weights, k=count))
+
+
+def tag_name(rank: int) -> str:
+    return 'tag_{:06d}'.format(rank)
@@ -0,0 +1,70 @@
+"""
+Puts two benchmark runs side by side, by default the last two runs in the results file.
+
+Usage: python benchmarks/compare.py [--base RUN] [--head RUN] [results.jsonl ...]
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run import DEFAULT_RESULTS
+
+__author__ = 'Chronoes'
+
+
+def load_runs(paths: list) -> dict:
+    """Returns dictionary of run to its records, in the order the runs were recorded"""
+    runs = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    runs.setdefault(record['run'], []).append(record)
+    return runs
+
+
+def case_key(record: dict) -> tuple:
+    return record['scenario'], tuple(sorted((key, str(value)) for key, value in record['params'].items()))
+
+
+def describe(key: tuple) -> str:
+    scenario, params = key
+    return ' '.join([scenario] + ['{}={}'.format(name, value) for name, value in params])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare median timings of two benchmark runs.')
+    parser.add_argument('results', nargs='*', default=[DEFAULT_RESULTS])
+    parser.add_argument('--base', help='Run to compare against, defaults to the second to last run')
+    parser.add_argument('--head', help='Run to compare, defaults to the last run')
+    args = parser.parse_args()
+
+    runs = load_runs(args.results)
+    names = list(runs)
+    if len(names) < 2 and not (args.base and args.head):
+        parser.error('Need at least two runs to compare')
+    base_name = args.base or names[-2]
+    head_name = args.head or names[-1]
+    base = {case_key(record): record for record in runs[base_name]}
+    head = {case_key(record): record for record in runs[head_name]}
+
+    def title(name):
+        record = runs[name][0]
+        return '{} ({}, {} images)'.format(name, record['commit'], record['images'])
+    print('base {}\nhead {}\n'.format(title(base_name), title(head_name)))
+    print('{:<64} {:>12} {:>12} {:>8}'.format('case', 'base ms', 'head ms', 'ratio'))
+    for key in sorted(set(base) | set(head)):
+        base_median = base[key]['median'] * 1000 if key in base else None
+        head_median = head[key]['median'] * 1000 if key in head else None
+        ratio = head_median / base_median if base_median and head_median is not None else None
+        print('{:<64} {:>12} {:>12} {:>8}'.format(describe(key),
+            '-' if base_median is None else '{:.2f}'.format(base_median),
+            '-' if head_median is None else '{:.2f}'.format(head_median),
+            '-' if ratio is None else '{:.2f}x'.format(ratio)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Generates a synthetic image library database for benchmarks.
+Tags per image and tag frequencies are skewed like on booru sites, and a share of images are linked into series.
+
+Usage: python benchmarks/generate_library.py [--images 10k|1m|10m|<count>] [--workdir DIR] [--seed N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+
+__author__ = 'Chronoes'
+
+SIZES = {'10k': 10 ** 4, '1m': 10 ** 6, '10m': 10 ** 7}
+DEFAULT_WORKDIR = os.path.join(common.REPO_PATH, 'benchmarks', 'work')
+INSERT_BATCH = 50000
+MIN_TAGS = 3
+MAX_TAGS = 40
+SERIES_SHARE = 0.05
+EXTENSIONS = ('.jpg', '.jpg', '.jpg', '.png', '.gif', '.webm')
+
+
+def parse_size(size: str) -> int:
+    return SIZES[size.lower()] if size.lower() in SIZES else int(size)
+
+
+def library_path(workdir: str, images: int) -> str:
+    return os.path.join(workdir, 'library-{}.sqlite'.format(images))
+
+
+def vocabulary_size(images: int) -> int:
+    return min(max(images // 10, 1000), 500000)
+
+
+def generate(path: str, images: int, seed=0, report=print):
+    """Creates the database at path with the project schema and fills it, path must be configured with common.setup"""
+    import database.database as db
+
+    for stale in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(stale):
+            os.remove(stale)
+    db.connect_db()
+    connection = db.db.connection()
+    # Nothing has to survive a crash while generating, and secondary indexes are faster to build afterwards
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('DROP INDEX IF EXISTS "imagetag_tag_id_image_id"')
+
+    sampler = common.TagSampler(vocabulary_size(images), seed=seed)
+    rng = sampler.random
+    with db.db.atomic():
+        connection.executemany('INSERT INTO "imagegroup" ("id", "name") VALUES (?, ?)',
+            enumerate(common.GROUPS, 1))
+        connection.executemany('INSERT INTO "tag" ("id", "tag") VALUES (?, ?)',
+            ((rank + 1, common.tag_name(rank)) for rank in sampler.ranks))
+
+    started = time.monotonic()
+    for batch_start in range(1, images + 1, INSERT_BATCH):
+        image_rows = []
+        tag_rows = []
+        for image_id in range(batch_start, min(batch_start + INSERT_BATCH, images + 1)):
+            # Series are chains of consecutive images
+            parent = image_id - 1 if image_id > 1 and rng.random() < SERIES_SHARE else None
+            image_rows.append((
+                image_id,
+                rng.randint(1, len(common.GROUPS)),
+                '{:032x}{}'.format(rng.getrandbits(128), rng.choice(EXTENSIONS)),
+                'https://konachan.com/post/show/{}'.format(image_id),
+                parent,
+                rng.randint(50 * 1024, 5 * 1024 * 1024)))
+            tag_count = min(MAX_TAGS, MIN_TAGS + int(rng.expovariate(1 / 12)))
+            tag_rows.extend((image_id, rank + 1) for rank in sorted(sampler.sample(tag_count)))
+
+        with db.db.atomic():
+            connection.executemany(
+                'INSERT INTO "image" ("id", "group_id", "filename", "original_link", "parent_id", "size") '
+                'VALUES (?, ?, ?, ?, ?, ?)', image_rows)
+            connection.executemany('INSERT INTO "imagetag" ("image_id", "tag_id") VALUES (?, ?)', tag_rows)
+        done = min(batch_start + INSERT_BATCH - 1, images)
+        report('{} of {} images, {:.0f}s'.format(done, images, time.monotonic() - started))
+
+    report('Building indexes')
+    connection.execute('CREATE INDEX IF NOT EXISTS "imagetag_tag_id_image_id" ON "imagetag" ("tag_id", "image_id")')
+    db.db.close()
+    db.connected = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic image library for benchmarks.')
+    parser.add_argument('--images', default='10k', help='Number of images, 10k, 1m, 10m or a count')
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    images = parse_size(args.images)
+    path = library_path(args.workdir, images)
+    common.setup(args.workdir, path)
+    generate(path, images, seed=args.seed)
+    print('Library written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""
+Runs timed benchmark scenarios against a synthetic library and records the results.
+Each scenario is repeated and its timings appended as one JSON line to the results file, together with the library
+size, commit and Python version, so runs from different commits can be put side by side with compare.py.
+
+Usage: python benchmarks/run.py [--images 10k|1m|10m|<count>] [--scenario NAME ...] [--repeat N] [--out FILE]
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common
+import generate_library
+from booru_server import MISSING_ID, start_server
+
+__author__ = 'Chronoes'
+
+DEFAULT_RESULTS = os.path.join(common.REPO_PATH, 'benchmarks', 'results', 'results.jsonl')
+SCENARIOS = ('query_results', 'process_tags', 'save', 'parse_page', 'get_image_bulk', 'index_route')
+BULK_SITES = ('konachan.com', 'yande.re', 'gelbooru.com')
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=common.REPO_PATH, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextlib.contextmanager
+def silenced():
+    """Sends output to /dev/null at the file descriptor level, as progress bars hold on to the original streams"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+class Recorder:
+    """Times scenarios and writes a record for each of them to the results file"""
+    def __init__(self, out_path: str, repeat: int, images: int):
+        self.out_path = out_path
+        self.repeat = repeat
+        self.run = {
+            'run': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'images': images,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+
+    def measure(self, scenario: str, func, setup=None, repeat=None, **params):
+        """Calls setup then times func repeat times, output of both is swallowed"""
+        timings = []
+        for _ in range(repeat or self.repeat):
+            with silenced():
+                args = setup() if setup else ()
+                started = time.perf_counter()
+                func(*args)
+                timings.append(time.perf_counter() - started)
+
+        timings.sort()
+        record = dict(self.run, scenario=scenario, params=params, repeat=len(timings),
+            min=timings[0], median=statistics.median(timings), mean=statistics.mean(timings),
+            p95=timings[min(len(timings) - 1, int(len(timings) * 0.95))])
+        with open(self.out_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        print('{:<16} {:<48} median {:9.2f} ms  min {:9.2f} ms'.format(
+            scenario, ' '.join('{}={}'.format(key, value) for key, value in params.items()),
+            record['median'] * 1000, record['min'] * 1000))
+        return record
+
+
+def search_cases(images: int) -> list:
+    """Keywords for a common tag, a mid-frequency tag, a rare tag, two tags together and a filename prefix"""
+    vocabulary = generate_library.vocabulary_size(images)
+    return [
+        ('common', [common.tag_name(0)], 'keyword'),
+        ('medium', [common.tag_name(vocabulary // 100)], 'keyword'),
+        ('rare', [common.tag_name(vocabulary - 1)], 'keyword'),
+        ('two_tags', [common.tag_name(1), common.tag_name(vocabulary // 200)], 'keyword'),
+        ('filename', ['ab'], 'filename'),
+    ]
+
+
+def bench_query_results(recorder: Recorder, images: int):
+    import database.tag_index as tag_index
+    from database.db_queries import query_results
+    from database.result_cache import result_cache
+
+    def run(split_line, query_type, after=None):
+        return lambda: list(query_results(split_line, query_type=query_type, after=after, limit=100))
+
+    recorder.measure('query_results', run([], 'keyword'), case='browse')
+    recorder.measure('query_results', run([], 'keyword', after=images // 2), case='browse_deep')
+
+    for engine in ('sqlite', 'memory'):
+        if engine == 'memory':
+            recorder.measure('tag_index_build', tag_index.build_index, repeat=1)
+        for case, split_line, query_type in search_cases(images):
+            recorder.measure('query_results', run(split_line, query_type), setup=lambda: result_cache.clear() or (),
+                case=case, engine=engine, cache='cold')
+            recorder.measure('query_results', run(split_line, query_type), case=case, engine=engine, cache='warm')
+    tag_index._index = None
+
+
+def bench_process_tags(recorder: Recorder, images: int):
+    import database.database as db
+    from main_functions import process_tags
+
+    rng = random.Random()
+    sampler = common.TagSampler(generate_library.vocabulary_size(images), seed=1)
+
+    def setup():
+        img = db.Image.get_by_id(rng.randint(1, images))
+        tags = [common.tag_name(rank) for rank in sampler.sample(20)]
+        # A few tags are new, as on posts with freshly made tags
+        tags.extend('bench_new_{:x}'.format(rng.getrandbits(64)) for _ in range(2))
+        return img, tags
+
+    recorder.measure('process_tags', process_tags, setup=setup, tags=22)
+
+
+def temp_image(rng: random.Random, sampler: common.TagSampler, group: str, directory: str, size=64 * 1024):
+    from downloaders import ImageInfo, PartialFile
+
+    post_id = rng.randint(MISSING_ID // 2, MISSING_ID - 1)
+    partial = PartialFile(directory)
+    partial.write(rng.randbytes(size))
+    partial.close()
+    return ImageInfo('https://konachan.com/image/{}.jpg'.format(post_id),
+        'https://konachan.com/post/show/{}'.format(post_id), [common.tag_name(rank) for rank in sampler.sample(20)],
+        group=group, path=partial.path, filename='bench_{:x}.jpg'.format(rng.getrandbits(64)),
+        content_hash=partial.content_hash())
+
+
+def bench_save(recorder: Recorder, images: int, config: dict):
+    from main_functions import BatchWriter, save
+
+    rng = random.Random()
+    sampler = common.TagSampler(generate_library.vocabulary_size(images), seed=2)
+    group = common.GROUPS[0]
+
+    recorder.measure('save', save, setup=lambda: (temp_image(rng, sampler, group, config['groups'][group]),))
+
+    batch_size = 100
+    def setup_batch():
+        writer = BatchWriter(batch_size=batch_size + 1)
+        for _ in range(batch_size):
+            writer(temp_image(rng, sampler, group, config['groups'][group]))
+        return (writer,)
+    recorder.measure('batch_writer', lambda writer: writer.flush(), setup=setup_batch, images=batch_size)
+
+
+def bench_parse_page(recorder: Recorder):
+    import requests
+    import downloaders
+
+    server, base_url = start_server()
+    try:
+        with requests.Session() as session:
+            pages = [(downloaders.KonachanParser(session, base_url + '/konachan.com/post/show/1'), 'konachan.com'),
+                (downloaders.GelbooruParser(session, base_url + '/gelbooru.com/index.php?page=post&s=view&id=1'),
+                'gelbooru.com')]
+            pages = [(parser, site, session.get(parser.url).text) for parser, site in pages]
+    finally:
+        server.shutdown()
+
+    for parser, site, text in pages:
+        recorder.measure('parse_page', lambda: parser.parse_image_info(text), site=site, parser='extractor')
+        recorder.measure('parse_page', lambda: parser.parse_image_info_soup(text), site=site, parser='soup')
+
+
+def bench_get_image_bulk(recorder: Recorder, urls: int, delay: float):
+    import downloaders
+    import main_functions
+    from main_functions import BatchWriter
+
+    server, base_url = start_server(delay=delay)
+    downloaders.GelbooruAPIParser.base_url = base_url + '/gelbooru.com/index.php'
+    rng = random.Random()
+
+    def post_urls():
+        # Fresh post IDs every time, known posts would be skipped before they are downloaded
+        ids = rng.sample(range(1, MISSING_ID // 2), urls)
+        return [(common.GROUPS[i % len(common.GROUPS)], '{}/{}'.format(base_url, url)) for i, url in enumerate(
+            'gelbooru.com/index.php?page=post&s=view&id={}'.format(post_id) if site == 'gelbooru.com'
+            else '{}/post/show/{}'.format(site, post_id)
+            for site, post_id in zip(rng.choices(BULK_SITES, k=urls), ids))]
+
+    engines = {'threads': main_functions.get_image_bulk}
+    try:
+        import async_engine
+        engines['asyncio'] = async_engine.get_image_bulk
+    except ImportError:
+        pass
+
+    def run(get_image_bulk):
+        def download(url_list):
+            with BatchWriter() as writer:
+                get_image_bulk(url_list, writer)
+        return download
+
+    try:
+        for engine, get_image_bulk in engines.items():
+            recorder.measure('get_image_bulk', run(get_image_bulk), setup=lambda: (post_urls(),),
+                repeat=max(1, recorder.repeat // 10), engine=engine, urls=urls, delay=delay)
+    finally:
+        server.shutdown()
+
+
+def bench_index_route(recorder: Recorder, images: int):
+    from imagedb.database.result_cache import result_cache
+    from imagedb.gui.server import app
+
+    client = app.test_client()
+    cases = [('form', {})]
+    cases.extend((case, {'keywords': ' '.join(split_line), 'qt': query_type})
+        for case, split_line, query_type in search_cases(images))
+    cases.append(('randomize', {'randomize': '1', 'keywords': common.tag_name(0)}))
+
+    def get(args):
+        def request():
+            response = client.get('/', query_string=args)
+            assert response.status_code == 200, response.status_code
+        return request
+
+    for case, args in cases:
+        recorder.measure('index_route', get(args), setup=lambda: result_cache.clear() or (), case=case, cache='cold')
+        recorder.measure('index_route', get(args), case=case, cache='warm')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run benchmark scenarios and record their timings.')
+    parser.add_argument('--images', default='10k', help='Library size, 10k, 1m, 10m or a count')
+    parser.add_argument('--workdir', default=generate_library.DEFAULT_WORKDIR)
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--urls', type=int, default=200, help='URLs per get_image_bulk run')
+    parser.add_argument('--delay', type=float, default=0.01, help='Seconds the booru stand-in waits per response')
+    parser.add_argument('--out', default=DEFAULT_RESULTS)
+    args = parser.parse_args()
+
+    images = generate_library.parse_size(args.images)
+    path = generate_library.library_path(args.workdir, images)
+    config = common.setup(args.workdir, path)
+    if not os.path.exists(path):
+        print('Generating library of {} images'.format(images))
+        generate_library.generate(path, images)
+
+    import database.database as db
+    db.connect_db()
+
+    recorder = Recorder(args.out, args.repeat, images)
+    if 'query_results' in args.scenario:
+        bench_query_results(recorder, images)
+    if 'process_tags' in args.scenario:
+        bench_process_tags(recorder, images)
+    if 'save' in args.scenario:
+        bench_save(recorder, images, config)
+    if 'parse_page' in args.scenario:
+        bench_parse_page(recorder)
+    if 'get_image_bulk' in args.scenario:
+        bench_get_image_bulk(recorder, args.urls, args.delay)
+    if 'index_route' in args.scenario:
+        bench_index_route(recorder, images)
+    print('Results appended to {}'.format(args.out))
+
+
+if __name__ == '__main__':
+    main()
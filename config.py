@@ -28,5 +28,8 @@ def load_config(path=None, reload_path=False):
     config['database']['path'] = _get_path(config['database']['path'])
     for key in config['groups']:
         config['groups'][key] = _get_path(config['groups'][key])
+    for section in ('thumbnails', 'fs_index'):
+        if config.get(section, {}).get('path'):
+            config[section]['path'] = _get_path(config[section]['path'])
 
     return config
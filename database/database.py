@@ -2,12 +2,33 @@
 """
 import peewee as pw
 
+from pathlib import Path
+from playhouse.pool import PooledSqliteDatabase
+
 from imagedb.config import load_config
+from imagedb.database import migrations
 
 __author__ = 'Chronoes'
 config = load_config()
 
-db = pw.SqliteDatabase(config['database']['path'])
+# WAL lets readers work alongside a writer, busy_timeout makes writers wait for each other instead of failing
+PRAGMAS = dict({
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 10000,
+}, **config['database'].get('pragmas', {}))
+READ_PRAGMAS = dict({
+    pragma: value for pragma, value in PRAGMAS.items() if pragma in ('cache_size', 'mmap_size', 'busy_timeout')
+}, query_only=1)
+
+# Connections are per thread, so every worker thread gets its own
+db = pw.SqliteDatabase(config['database']['path'], pragmas=PRAGMAS, timeout=PRAGMAS['busy_timeout'] / 1000)
+read_db = None
+
+# Stay well below SQLite's host parameter limit when filtering on id lists
+MAX_QUERY_PARAMS = 500
 
 class BaseModel(pw.Model):
     class Meta:
@@ -19,19 +40,34 @@ class ImageGroup(BaseModel):
 class Image(BaseModel):
     group = pw.ForeignKeyField(ImageGroup)
     filename = pw.CharField(unique=True)
-    original_link = pw.CharField()
+    original_link = pw.CharField(index=True)
+    # SHA-256 of the file, for finding the same file saved under different names
+    content_hash = pw.CharField(null=True, index=True)
+    # Size of the file in bytes, for checking files against the database
+    size = pw.IntegerField(null=True)
     # In reality, there should only be one child per parent as it is meant to be a linked list
     parent = pw.ForeignKeyField('self', null=True, backref='children')
+    # Write generation at which the image or its tags last changed, for picking up changes in the tag index
+    generation = pw.IntegerField(null=True, index=True)
 
 class Tag(BaseModel):
     tag = pw.CharField(unique=True)
 
 class ImageTag(BaseModel):
-    image = pw.ForeignKeyField(Image)
-    tag = pw.ForeignKeyField(Tag)
+    # Both directions are covered by the primary key and the (tag, image) index
+    image = pw.ForeignKeyField(Image, index=False)
+    tag = pw.ForeignKeyField(Tag, index=False)
 
     class Meta:
         primary_key = pw.CompositeKey('image', 'tag')
+        indexes = (
+            (('tag', 'image'), False),
+        )
+        without_rowid = True
+
+class Generation(BaseModel):
+    """Single row counter that every write to images or their tags increases, for invalidating cached results"""
+    value = pw.IntegerField(default=0)
 
 connected = False
 
@@ -41,7 +77,43 @@ def connect_db():
         return db
 
     db.connect()
-    models = [ImageGroup, Image, Tag, ImageTag]
-    db.create_tables(models, safe=True)
+    models = [ImageGroup, Image, Tag, ImageTag, Generation]
+    if not db.table_exists(Image._meta.table_name):
+        # New databases are created with the latest schema
+        db.create_tables(models, safe=True)
+        migrations.set_version(db, migrations.LATEST_VERSION)
+    else:
+        # Migrations go first, as model indexes may be on columns that older databases do not have yet
+        migrations.migrate(db)
+        db.create_tables(models, safe=True)
     connected = True
     return db
+
+def use_read_pool(max_connections=None):
+    """Sends queries from db_queries through a pool of read-only connections, for the web server"""
+    global read_db
+    read_db = PooledSqliteDatabase(
+        Path(config['database']['path']).as_uri() + '?mode=ro',
+        uri=True,
+        pragmas=READ_PRAGMAS,
+        timeout=PRAGMAS['busy_timeout'] / 1000,
+        max_connections=max_connections or config['database'].get('read_pool_size', 8),
+        stale_timeout=300)
+    return read_db
+
+def reader():
+    """Database for read queries, read-only pool if one is in use"""
+    return read_db or db
+
+def bump_generation() -> int:
+    """
+    Marks images or tags as changed, should be called in the transaction that changes them.
+    Returns the new generation, which the changed images should be stamped with.
+    """
+    Generation.insert(id=1, value=1) \
+        .on_conflict(conflict_target=[Generation.id], update={Generation.value: Generation.value + 1}) \
+        .execute()
+    return Generation.select(Generation.value).where(Generation.id == 1).scalar()
+
+def current_generation() -> int:
+    return Generation.select(Generation.value).where(Generation.id == 1).bind(reader()).scalar() or 0
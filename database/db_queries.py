@@ -1,44 +1,223 @@
-from .database import ImageTag, Image, ImageGroup, Tag
+import functools
+import operator
+import random
 
-def imagetag_subquery(tag):
-    return ImageTag.select(ImageTag.image).where(Tag.tag.startswith(tag)).join(Tag)
+from bisect import bisect_left
+from collections import defaultdict
 
-def query_results(split_line: list, groups=None, query_type='keyword'):
-    query = Image.select() \
+from peewee import SQL, chunked, fn
+
+from . import tag_index
+from .tag_vocabulary import get_vocabulary
+from .database import MAX_QUERY_PARAMS, ImageTag, Image, ImageGroup, Tag, reader
+from .tag_cache import tag_cache
+from .result_cache import result_cache
+
+# Random sampling draws this many candidate IDs per wanted image from the ID range
+RANDOM_OVERSAMPLE = 4
+RANDOM_ROUNDS = 4
+
+def imagetag_subquery(tag_ids: list):
+    return ImageTag.select(ImageTag.image).where(ImageTag.tag << id_list(tag_ids))
+
+def id_list(ids: list):
+    """Inlines integer IDs into the query, as long lists would go over SQLite's parameter limit"""
+    return SQL('({})'.format(','.join(str(int(i)) for i in ids)))
+
+def find_tag_ids(keyword: str):
+    return get_vocabulary().find_prefix(keyword)
+
+def query_results(split_line: list, groups=None, query_type='keyword', after=None, limit=None):
+    """
+    Images are ordered from newest to oldest. For keyset pagination, pass the ID of the last image on the
+    previous page as after.
+    """
+    query = Image.select(Image, ImageGroup) \
         .order_by(Image.id.desc()) \
-        .join(ImageGroup)
+        .join(ImageGroup) \
+        .bind(reader())
 
     if groups is not None and len(groups) > 0:
         query = query.where(ImageGroup.id << groups)
+    if after is not None:
+        query = query.where(Image.id < after)
+    if limit is not None:
+        query = query.limit(limit)
 
     if len(split_line) > 0:
-        if query_type == 'filename':
-            ilike_qry = '{}%'
-            query = query.where(Image.filename ** ilike_qry.format(split_line[0]))
-            for filename in split_line[1:]:
-                query |= Image.filename ** ilike_qry.format(filename)
-            return query
-        else:
-            imagetags = imagetag_subquery(split_line[0])
-            for tag in split_line[1:]:
-                imagetags &= imagetag_subquery(tag)
-            return query.where(Image.id << imagetags).group_by(Image.id)
+        ids = cached_ids(split_line, groups=groups, query_type=query_type)
+        if ids is None:
+            # Bounded page query, SQLite stops after limit matches walking the ID index backwards
+            return query.where(Image.id << search_query(split_line, groups=groups, query_type=query_type).order_by())
+        return query.where(Image.id << id_list(paginate_ids(ids, after, limit)))
     else:
         return query
 
+def search_query(split_line: list, groups=None, query_type='keyword'):
+    """SQLite query for IDs of images matching the keywords or filenames in ascending order"""
+    query = Image.select(Image.id).order_by(Image.id).bind(reader())
+    if groups is not None and len(groups) > 0:
+        query = query.where(Image.group << groups)
+
+    if len(split_line) == 0:
+        return query
+    elif query_type == 'filename':
+        ilike_qry = '{}%'
+        return query.where(functools.reduce(
+            operator.or_, (Image.filename ** ilike_qry.format(filename) for filename in split_line)))
+
+    keyword_tag_ids = [find_tag_ids(keyword) for keyword in split_line]
+    imagetags = imagetag_subquery(keyword_tag_ids[0])
+    for tag_ids in keyword_tag_ids[1:]:
+        imagetags &= imagetag_subquery(tag_ids)
+    return query.where(Image.id << imagetags)
+
+def search_ids(split_line: list, groups=None, query_type='keyword'):
+    """Returns IDs of images matching the keywords or filenames in ascending order, through the result cache"""
+    return result_cache.get(result_cache.key(split_line, groups, query_type),
+        lambda: query_ids(split_line, groups=groups, query_type=query_type))
+
+def cached_ids(split_line: list, groups=None, query_type='keyword'):
+    """
+    Returns IDs of matching images for paging through them in memory, or None if a page query is cheaper.
+    Tag index searches are in memory anyway, SQLite results are only loaded once a search is repeated.
+    """
+    if tag_index.get_index() is not None and query_type == 'keyword':
+        return search_ids(split_line, groups=groups, query_type=query_type)
+    return result_cache.get_if_reused(result_cache.key(split_line, groups, query_type),
+        lambda: query_ids(split_line, groups=groups, query_type=query_type))
+
+def count_results(split_line: list, groups=None, query_type='keyword') -> int:
+    if len(split_line) > 0:
+        ids = cached_ids(split_line, groups=groups, query_type=query_type)
+        if ids is not None:
+            return len(ids)
+        return search_query(split_line, groups=groups, query_type=query_type) \
+            .order_by() \
+            .count()
+    return query_results([], groups=groups) \
+        .select(Image.id) \
+        .order_by() \
+        .count()
+
+def paginate_ids(ids: list, after=None, limit=None):
+    """Applies keyset pagination to a list of image IDs in ascending order, returning the page newest first"""
+    end = bisect_left(ids, after) if after is not None else len(ids)
+    start = max(end - limit, 0) if limit is not None else 0
+    return ids[start:end][::-1]
+
+
+def query_ids(split_line: list, groups=None, query_type='keyword'):
+    """Returns IDs of all matching images in ascending order, bypassing the result cache"""
+    index = tag_index.get_index()
+    if index is not None and query_type == 'keyword' and len(split_line) > 0:
+        index.refresh()
+        return index.search([find_tag_ids(keyword) for keyword in split_line], groups=groups)
+    query = search_query(split_line, groups=groups, query_type=query_type).tuples()
+    return [image_id for (image_id,) in query.iterator()]
+
+def _sample_id_range(groups, count):
+    """
+    Samples IDs by drawing random candidates from the whole ID range and keeping the ones that exist.
+    Every matching image is equally likely to be drawn, so the sample stays uniform.
+    Returns None if the range is too sparse to fill the sample in a few rounds.
+    """
+    low, high = Image.select(fn.MIN(Image.id), fn.MAX(Image.id)).bind(reader()).tuples().get()
+    if low is None:
+        return []
+    id_range = range(low, high + 1)
+
+    drawn = set()
+    found = []
+    for _ in range(RANDOM_ROUNDS):
+        needed = count - len(found)
+        if needed <= 0 or len(drawn) == len(id_range):
+            break
+        candidates = set(random.sample(id_range, min(needed * RANDOM_OVERSAMPLE, len(id_range)))) - drawn
+        drawn |= candidates
+
+        query = Image.select(Image.id).where(Image.id << id_list(candidates)).bind(reader())
+        if groups:
+            query = query.where(Image.group << groups)
+        found.extend(image_id for (image_id,) in query.tuples())
+
+    if len(found) >= count or len(drawn) == len(id_range):
+        # Found IDs come back in index order, so trim the extras randomly
+        return random.sample(found, min(count, len(found)))
+    return None
+
+def random_results(split_line: list, groups=None, query_type='keyword', count=100):
+    """Returns query for a uniform random sample of matching images without sorting the whole result set"""
+    ids = _sample_id_range(groups, count) if len(split_line) == 0 else None
+    if ids is None:
+        ids = search_ids(split_line, groups=groups, query_type=query_type)
+        ids = random.sample(ids, min(count, len(ids)))
+
+    return Image.select(Image, ImageGroup) \
+        .join(ImageGroup) \
+        .where(Image.id << id_list(ids)) \
+        .order_by(fn.Random()) \
+        .bind(reader())
 
 def query_by_id(ids: list):
-    query = Image.select().where(Image.id << ids).join(ImageGroup)
+    query = Image.select().where(Image.id << ids).join(ImageGroup).bind(reader())
     return list(query)
 
 def find_by_filename(filename: str):
-    return Image.get(Image.filename == filename)
+    return Image.select().where(Image.filename == filename).bind(reader()).get()
 
 def find_group(group: str):
-    return ImageGroup.get(ImageGroup.name == group)
+    return ImageGroup.select().where(ImageGroup.name == group).bind(reader()).get()
+
+def find_original_links(links: list) -> set:
+    """Returns the subset of original links that are already in the database"""
+    found = set()
+    for links_chunk in chunked(set(links), MAX_QUERY_PARAMS):
+        query = Image.select(Image.original_link).where(Image.original_link << links_chunk).bind(reader()).tuples()
+        found.update(link for (link,) in query)
+    return found
+
+def find_content_hashes(hashes) -> dict:
+    """Returns dictionary of content hash to filename for the hashes that are already in the database"""
+    found = {}
+    for hashes_chunk in chunked(set(hashes), MAX_QUERY_PARAMS):
+        query = Image.select(Image.content_hash, Image.filename) \
+            .where(Image.content_hash << hashes_chunk) \
+            .bind(reader()) \
+            .tuples()
+        found.update(query)
+    return found
 
 def get_groups():
-    return ImageGroup.select()
+    return ImageGroup.select().bind(reader())
 
 def get_image_tags(img):
-    return (tag.tag for tag in Tag.select(Tag.tag).where(ImageTag.image == img).join(ImageTag).order_by(Tag.tag))
+    query = Tag.select(Tag.tag).where(ImageTag.image == img).join(ImageTag).order_by(Tag.tag).bind(reader())
+    return (tag.tag for tag in query)
+
+def get_image_tag_ids(img) -> list:
+    query = ImageTag.select(ImageTag.tag).where(ImageTag.image == img).bind(reader()).tuples()
+    return [tag_id for (tag_id,) in query]
+
+def get_tags_by_image(image_ids: list):
+    """Returns dictionary of image ID to its sorted tags, fetched in batches"""
+    tag_ids = defaultdict(list)
+    for ids in chunked(image_ids, MAX_QUERY_PARAMS):
+        query = ImageTag.select(ImageTag.image, ImageTag.tag) \
+            .where(ImageTag.image << ids) \
+            .bind(reader()) \
+            .tuples()
+        for image_id, tag_id in query:
+            tag_ids[image_id].append(tag_id)
+
+    tag_names = tag_cache.get_tags(set(tag_id for ids in tag_ids.values() for tag_id in ids))
+    tags = defaultdict(list)
+    for image_id, ids in tag_ids.items():
+        tags[image_id] = sorted(tag_names[tag_id] for tag_id in ids)
+    return tags
+
+def with_tags(query):
+    """Materializes image query into list of (image, tags) with a fixed number of queries"""
+    images = list(query)
+    tags = get_tags_by_image([image.id for image in images])
+    return [(image, tags[image.id]) for image in images]
@@ -5,7 +5,9 @@ import os.path
 
 from peewee import *
 
-import database as new_db
+import imagedb.database.database as new_db
+
+from imagedb.database.tag_cache import tag_cache
 
 __author__ = 'Chronoes'
 
@@ -59,8 +61,8 @@ if __name__ == '__main__':
 
             image_tags = [tag.tag for tag in Tag.select().where(ImageTag.image == image).join(ImageTag)]
             if len(image_tags) > 0:
-                tags = new_db.Tag.select().where(new_db.Tag.tag << image_tags)
-                new_db.ImageTag.insert_many({'image': new_img, 'tag': tag} for tag in tags).execute()
+                tag_ids = tag_cache.get_ids(image_tags)
+                new_db.ImageTag.insert_many({'image': new_img, 'tag': tag_id} for tag_id in tag_ids.values()).execute()
             else:
                 print(image.filename)
                 # select * from image left join imagetag on (image.id = imagetag.image_id) group by image.id having count(imagetag.image_id) = 0;
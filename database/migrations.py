@@ -0,0 +1,115 @@
+"""
+Versioned schema migrations for existing databases.
+The schema version is kept in SQLite's user_version pragma, every migration runs in its own transaction.
+
+Usage: python -m imagedb.database.migrations [--explain]
+"""
+import sys
+
+__author__ = 'Chronoes'
+
+
+def add_lookup_indexes(db):
+    # Covering index for keyword searches, which go from tag to images
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "imagetag_tag_id_image_id" ON "imagetag" ("tag_id", "image_id")')
+    # Parent lookups when saving and redownloading go by original link
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "image_original_link" ON "image" ("original_link")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "image_group_id" ON "image" ("group_id")')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "image_parent_id" ON "image" ("parent_id")')
+
+
+def imagetag_without_rowid(db):
+    # Rows are stored in the primary key B-tree directly, which halves the size of the table
+    db.execute_sql('''
+        CREATE TABLE "imagetag_new" (
+            "image_id" INTEGER NOT NULL,
+            "tag_id" INTEGER NOT NULL,
+            PRIMARY KEY ("image_id", "tag_id"),
+            FOREIGN KEY ("image_id") REFERENCES "image" ("id"),
+            FOREIGN KEY ("tag_id") REFERENCES "tag" ("id")
+        ) WITHOUT ROWID''')
+    db.execute_sql('INSERT OR IGNORE INTO "imagetag_new" ("image_id", "tag_id") SELECT "image_id", "tag_id" FROM "imagetag"')
+    db.execute_sql('DROP TABLE "imagetag"')
+    db.execute_sql('ALTER TABLE "imagetag_new" RENAME TO "imagetag"')
+    # Single column indexes are covered by the primary key and the covering index
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "imagetag_tag_id_image_id" ON "imagetag" ("tag_id", "image_id")')
+
+
+def add_content_hash(db):
+    # Filled in at ingest, existing images are hashed with main.py --backfill-hashes
+    db.execute_sql('ALTER TABLE "image" ADD COLUMN "content_hash" VARCHAR(255)')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "image_content_hash" ON "image" ("content_hash")')
+
+
+def add_size(db):
+    # Filled in at ingest, existing images get theirs with main.py --backfill-hashes
+    db.execute_sql('ALTER TABLE "image" ADD COLUMN "size" INTEGER')
+
+
+def add_image_generation(db):
+    # Stamped on every change to an image or its tags, so the tag index can pick up changes from other processes
+    db.execute_sql('ALTER TABLE "image" ADD COLUMN "generation" INTEGER')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "image_generation" ON "image" ("generation")')
+
+
+MIGRATIONS = [
+    add_lookup_indexes,
+    imagetag_without_rowid,
+    add_content_hash,
+    add_size,
+    add_image_generation,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_version(db) -> int:
+    return db.pragma('user_version')
+
+
+def set_version(db, version: int):
+    db.pragma('user_version', version)
+
+
+def migrate(db):
+    """Applies migrations newer than the database's schema version, returns list of applied migration names"""
+    version = get_version(db)
+    applied = []
+    for next_version, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with db.atomic():
+            migration(db)
+            set_version(db, next_version)
+        applied.append(migration.__name__)
+    return applied
+
+
+def explain_query_results():
+    """Prints query plans for the query shapes used by searching and saving"""
+    from .database import Image, Tag, db
+    from .db_queries import query_results, search_query
+
+    keywords = [tag for (tag,) in Tag.select(Tag.tag).order_by(Tag.id).limit(2).tuples()] or ['a', 'b']
+    shapes = {
+        'browse': query_results([], limit=100),
+        'browse page': query_results([], after=1000, limit=100),
+        'browse groups': query_results([], groups=[1], limit=100),
+        'keyword': search_query(keywords[:1]),
+        'keywords with groups': search_query(keywords, groups=[1]),
+        'filename': search_query(['a'], query_type='filename'),
+        'parent lookup': Image.select(Image.id).where(Image.original_link == 'https://example.com'),
+        'children': Image.select(Image.id).where(Image.parent == 1),
+        'content hash': Image.select(Image.filename).where(Image.content_hash == '0' * 64),
+    }
+    for name, query in shapes.items():
+        sql, params = query.sql()
+        print('{} (schema version {}):'.format(name, get_version(db)))
+        for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params):
+            print('    ' + row[-1])
+
+
+if __name__ == '__main__':
+    from .database import connect_db
+
+    database = connect_db()
+    if '--explain' in sys.argv:
+        explain_query_results()
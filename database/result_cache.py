@@ -0,0 +1,92 @@
+"""
+Cache of search results as lists of image IDs.
+Entries are tagged with the write generation they were computed at, so any write to images or tags, from this or
+another process, makes them stale.
+"""
+import threading
+
+from array import array
+from collections import OrderedDict
+
+from .database import config, current_generation
+
+__author__ = 'Chronoes'
+
+# IDs are stored as 8 byte integers, so the default holds up to 32 MB of results
+DEFAULT_MAX_IDS = 4000000
+MAX_MISSES = 256
+
+
+class ResultCache:
+    """LRU cache of search key to IDs of matching images in ascending order, bounded by the total number of IDs"""
+    def __init__(self, max_ids=DEFAULT_MAX_IDS):
+        self.max_ids = max_ids
+        self.cached_ids = 0
+        self.results = OrderedDict()
+        # Key -> generation of searches that missed once, for get_if_reused
+        self.misses = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(split_line: list, groups, query_type: str) -> tuple:
+        return tuple(sorted(split_line)), tuple(sorted(str(group) for group in groups or ())), query_type
+
+    def get(self, key: tuple, compute):
+        """Returns cached IDs for key, calling compute for them if there are none from the current generation"""
+        # Read before computing, so results of a write that lands in between are never kept as current
+        generation = current_generation()
+        with self.lock:
+            ids = self._current(key, generation)
+        if ids is not None:
+            return ids
+        return self._store(key, generation, compute)
+
+    def get_if_reused(self, key: tuple, compute):
+        """
+        Like get, but returns None on the first miss of a key, so loading every matching ID only pays off for searches
+        repeated before the next write. Callers should run a bounded query instead.
+        """
+        generation = current_generation()
+        with self.lock:
+            ids = self._current(key, generation)
+            if ids is not None:
+                return ids
+            if self.misses.get(key) != generation:
+                self.misses[key] = generation
+                self.misses.move_to_end(key)
+                while len(self.misses) > MAX_MISSES:
+                    self.misses.popitem(last=False)
+                return None
+            del self.misses[key]
+        return self._store(key, generation, compute)
+
+    def _current(self, key: tuple, generation: int):
+        entry = self.results.get(key)
+        if entry is not None and entry[0] == generation:
+            self.results.move_to_end(key)
+            return entry[1]
+        return None
+
+    def _store(self, key: tuple, generation: int, compute):
+        ids = array('q', compute())
+        if len(ids) > self.max_ids:
+            return ids
+        with self.lock:
+            previous = self.results.pop(key, None)
+            if previous is not None:
+                self.cached_ids -= len(previous[1])
+            self.results[key] = (generation, ids)
+            self.cached_ids += len(ids)
+            while self.cached_ids > self.max_ids:
+                _, (_, evicted) = self.results.popitem(last=False)
+                self.cached_ids -= len(evicted)
+        return ids
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.misses.clear()
+            self.cached_ids = 0
+
+
+result_cache = ResultCache(config.get('search', {}).get('result_cache_ids', DEFAULT_MAX_IDS))
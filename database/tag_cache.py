@@ -0,0 +1,113 @@
+"""
+Process-wide cache between tag names and tag IDs.
+Tags repeat heavily across images, so a warm cache only goes to the Tag table for tags it has never seen.
+"""
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+from peewee import chunked
+
+from .database import MAX_QUERY_PARAMS, Tag, config, reader
+
+__author__ = 'Chronoes'
+
+DEFAULT_SIZE = 100000
+# RETURNING is only supported since SQLite 3.35
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class TagCache:
+    """Bounded LRU cache of tag to ID, with the reverse lookup kept in sync"""
+    def __init__(self, max_size=DEFAULT_SIZE):
+        self.max_size = max_size
+        self.ids = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def _add(self, tag: str, tag_id: int):
+        self.ids[tag] = tag_id
+        self.ids.move_to_end(tag)
+        self.tags[tag_id] = tag
+        while len(self.ids) > self.max_size:
+            _, evicted_id = self.ids.popitem(last=False)
+            del self.tags[evicted_id]
+
+    def get_ids(self, tags, pending: dict=None) -> dict:
+        """
+        Returns dictionary of tag to tag ID, inserting the tags that do not exist yet.
+        Inside a transaction, pass a pending dictionary and add it to the cache once the transaction commits, as IDs of
+        rolled back tags would otherwise be handed out again for other tags.
+        """
+        tag_ids = {}
+        missing = []
+        with self.lock:
+            for tag in set(tags):
+                if tag in self.ids:
+                    tag_ids[tag] = self.ids[tag]
+                    self.ids.move_to_end(tag)
+                else:
+                    missing.append(tag)
+        if not missing:
+            return tag_ids
+
+        fetched = {}
+        for tags_chunk in chunked(missing, MAX_QUERY_PARAMS):
+            fetched.update(Tag.select(Tag.tag, Tag.id).where(Tag.tag << tags_chunk).tuples())
+
+        new_tags = [tag for tag in missing if tag not in fetched]
+        for tags_chunk in chunked(new_tags, MAX_QUERY_PARAMS):
+            query = Tag.insert_many({'tag': tag} for tag in tags_chunk).on_conflict(action='NOTHING')
+            if SUPPORTS_RETURNING:
+                fetched.update(query.returning(Tag.tag, Tag.id).tuples().execute())
+            else:
+                query.execute()
+            # Tags inserted by another writer in the meantime are not returned
+            remaining = [tag for tag in tags_chunk if tag not in fetched]
+            if remaining:
+                fetched.update(Tag.select(Tag.tag, Tag.id).where(Tag.tag << remaining).tuples())
+
+        if pending is not None:
+            pending.update(fetched)
+        else:
+            self.add(fetched)
+        tag_ids.update(fetched)
+        return tag_ids
+
+    def add(self, tag_ids: dict):
+        """Caches dictionary of tag to tag ID"""
+        with self.lock:
+            for tag, tag_id in tag_ids.items():
+                self._add(tag, tag_id)
+
+    def get_tags(self, tag_ids) -> dict:
+        """Returns dictionary of tag ID to tag"""
+        tags = {}
+        missing = []
+        with self.lock:
+            for tag_id in set(tag_ids):
+                if tag_id in self.tags:
+                    tags[tag_id] = self.tags[tag_id]
+                    self.ids.move_to_end(tags[tag_id])
+                else:
+                    missing.append(tag_id)
+        if not missing:
+            return tags
+
+        fetched = {}
+        for ids_chunk in chunked(missing, MAX_QUERY_PARAMS):
+            fetched.update(Tag.select(Tag.id, Tag.tag).where(Tag.id << ids_chunk).bind(reader()).tuples())
+        with self.lock:
+            for tag_id, tag in fetched.items():
+                self._add(tag, tag_id)
+        tags.update(fetched)
+        return tags
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+            self.tags.clear()
+
+
+tag_cache = TagCache(config['database'].get('tag_cache_size', DEFAULT_SIZE))
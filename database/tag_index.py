@@ -0,0 +1,257 @@
+"""
+In-memory inverted index of tags for multi-tag AND searches.
+Every tag ID maps to a sorted array of image IDs (posting list), so searches are done by intersecting arrays
+instead of running a subquery per keyword in SQLite.
+"""
+import threading
+
+from array import array
+from bisect import bisect_left
+
+from peewee import SQL, chunked
+
+from .database import MAX_QUERY_PARAMS, Image, ImageTag, current_generation, reader
+
+__author__ = 'Chronoes'
+
+# Switch from set intersection to binary search probes when the other list is this many times larger
+GALLOP_RATIO = 16
+
+
+def _union(postings: list) -> array:
+    if len(postings) == 1:
+        return postings[0]
+    return array('q', sorted(set().union(*postings)))
+
+
+def _intersect(smaller: array, larger: array) -> array:
+    if len(smaller) * GALLOP_RATIO < len(larger):
+        result = array('q')
+        lo = 0
+        for image_id in smaller:
+            lo = bisect_left(larger, image_id, lo)
+            if lo == len(larger):
+                break
+            if larger[lo] == image_id:
+                result.append(image_id)
+        return result
+    return array('q', sorted(set(smaller).intersection(larger)))
+
+
+def _group_ids(groups) -> set:
+    """Converts group filter values to IDs, values that are not numbers match no group like they do in SQLite"""
+    group_ids = set()
+    for group in groups:
+        try:
+            group_ids.add(int(group))
+        except (TypeError, ValueError):
+            pass
+    return group_ids
+
+
+def _insert(ids: array, value: int):
+    if not ids or ids[-1] < value:
+        ids.append(value)
+        return
+    i = bisect_left(ids, value)
+    if i == len(ids) or ids[i] != value:
+        ids.insert(i, value)
+
+
+def _remove(ids: array, value: int):
+    i = bisect_left(ids, value)
+    if i < len(ids) and ids[i] == value:
+        del ids[i]
+
+
+class TagIndex:
+    def __init__(self):
+        self.postings = {}
+        # Group ID of every indexed image at the position of its ID, 0 where there is no indexed image.
+        # Tags of an image are not kept apart from the postings, callers read the ones being replaced from ImageTag.
+        self.image_groups = array('i')
+        self.image_count = 0
+        self.last_image_id = 0
+        # Write generation that the index has every change up to
+        self.generation = 0
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+
+    def load(self, after_id=0):
+        """Loads images with ID greater than after_id from the database"""
+        # Read first, so changes made while loading are picked up again by the next refresh
+        generation = current_generation()
+        images = Image.select(Image.id, Image.group) \
+            .where(Image.id > after_id) \
+            .order_by(Image.id) \
+            .bind(reader()) \
+            .tuples()
+        image_tags = ImageTag.select(ImageTag.image, ImageTag.tag) \
+            .where(ImageTag.image > after_id) \
+            .order_by(ImageTag.image) \
+            .bind(reader()) \
+            .tuples()
+
+        with self.lock:
+            for image_id, group_id in images.iterator():
+                self._set_group(image_id, group_id)
+                self.last_image_id = max(self.last_image_id, image_id)
+            # Rows come in image order, so appending keeps posting lists sorted
+            for image_id, tag_id in image_tags.iterator():
+                if not self._group(image_id):
+                    # Tags left behind by a deleted image
+                    continue
+                _insert(self.postings.setdefault(tag_id, array('q')), image_id)
+            self.generation = max(self.generation, generation)
+
+    def refresh(self):
+        """
+        Picks up images added, deleted, and images whose tags or group changed, in other processes since the last load.
+        Images are stamped with the write generation of their last change, so only those are read again.
+        """
+        with self.refresh_lock:
+            generation = current_generation()
+            if generation == self.generation:
+                return
+            images = Image.select(Image.id, Image.group) \
+                .where((Image.id > self.last_image_id) | (Image.generation > self.generation)) \
+                .order_by(Image.id) \
+                .bind(reader()) \
+                .tuples()
+            # Tags that changed images had before are gone from the database, so those are applied together after
+            # one pass over the postings
+            changed = {}
+            for images_chunk in chunked(images.iterator(), MAX_QUERY_PARAMS):
+                image_tags = self._read_tags(image_id for image_id, _ in images_chunk)
+                for image_id, group_id in images_chunk:
+                    if self._group(image_id):
+                        changed[image_id] = (group_id, image_tags.get(image_id, []))
+                    else:
+                        self.set_image_tags(image_id, group_id, image_tags.get(image_id, []))
+            if changed:
+                with self.lock:
+                    self._remove_postings(set(changed))
+                    for image_id, (group_id, tag_ids) in changed.items():
+                        self.set_image_tags(image_id, group_id, tag_ids)
+            self._remove_deleted()
+            self.generation = generation
+
+    @staticmethod
+    def _read_tags(image_ids) -> dict:
+        image_ids = SQL('({})'.format(','.join(str(image_id) for image_id in image_ids)))
+        query = ImageTag.select(ImageTag.image, ImageTag.tag) \
+            .where(ImageTag.image << image_ids) \
+            .order_by(ImageTag.image, ImageTag.tag) \
+            .bind(reader()) \
+            .tuples()
+        image_tags = {}
+        for image_id, tag_id in query:
+            image_tags.setdefault(image_id, []).append(tag_id)
+        return image_tags
+
+    def _remove_deleted(self):
+        """
+        Removes images deleted in other processes. Deletions leave nothing behind to select, so the indexed IDs are
+        compared against the ones in the database, but only when there are fewer images than indexed.
+        """
+        if Image.select().bind(reader()).count() >= self.image_count:
+            return
+        query = Image.select(Image.id).order_by(Image.id).bind(reader()).tuples()
+        existing = (image_id for (image_id,) in query.iterator())
+        current = next(existing, None)
+        deleted = set()
+        for image_id, group_id in enumerate(self.image_groups):
+            if not group_id:
+                continue
+            while current is not None and current < image_id:
+                current = next(existing, None)
+            if current != image_id:
+                deleted.add(image_id)
+        if deleted:
+            with self.lock:
+                self._remove_postings(deleted)
+                for image_id in deleted:
+                    self._set_group(image_id, 0)
+
+    def set_image_tags(self, image_id: int, group_id: int, tag_ids: list, old_tag_ids=()):
+        """Indexes image with its tags, replacing old_tag_ids, the tags it had in ImageTag before the change"""
+        with self.lock:
+            for tag_id in old_tag_ids:
+                _remove(self.postings.get(tag_id, array('q')), image_id)
+            for tag_id in tag_ids:
+                _insert(self.postings.setdefault(tag_id, array('q')), image_id)
+            self._set_group(image_id, group_id)
+            self.last_image_id = max(self.last_image_id, image_id)
+
+    def set_image_group(self, image_id: int, group_id: int):
+        with self.lock:
+            if self._group(image_id):
+                self._set_group(image_id, group_id)
+
+    def remove_image(self, image_id: int, tag_ids=None):
+        """Removes image with the tags it had in ImageTag, or from every posting list if they are not known"""
+        with self.lock:
+            if tag_ids is None:
+                self._remove_postings({image_id})
+            else:
+                for tag_id in tag_ids:
+                    _remove(self.postings.get(tag_id, array('q')), image_id)
+            self._set_group(image_id, 0)
+
+    def _group(self, image_id: int) -> int:
+        return self.image_groups[image_id] if image_id < len(self.image_groups) else 0
+
+    def _set_group(self, image_id: int, group_id: int):
+        groups = self.image_groups
+        if image_id >= len(groups):
+            if not group_id:
+                return
+            groups.frombytes(bytes((image_id + 1 - len(groups)) * groups.itemsize))
+        self.image_count += bool(group_id) - bool(groups[image_id])
+        groups[image_id] = group_id
+
+    def _remove_postings(self, image_ids: set):
+        """Removes images from every posting list, a pass over all of them for when their tags are not known"""
+        for tag_id, ids in self.postings.items():
+            if not image_ids.isdisjoint(ids):
+                self.postings[tag_id] = array('q', (image_id for image_id in ids if image_id not in image_ids))
+
+    def search(self, keyword_tag_ids: list, groups=None) -> list:
+        """
+        Finds images that match every keyword, where each keyword is given as a collection of matching tag IDs.
+        Returns image IDs in ascending order.
+        """
+        with self.lock:
+            keyword_postings = []
+            for tag_ids in keyword_tag_ids:
+                postings = [self.postings[tag_id] for tag_id in tag_ids if tag_id in self.postings]
+                if not postings:
+                    return []
+                keyword_postings.append(_union(postings))
+
+            keyword_postings.sort(key=len)
+            result = keyword_postings[0]
+            for postings in keyword_postings[1:]:
+                if not result:
+                    break
+                result = _intersect(result, postings)
+
+            if groups:
+                groups = _group_ids(groups)
+                # Posting lists only hold indexed images, which all have a place in the groups array
+                image_groups = self.image_groups
+                return array('q', (image_id for image_id in result if image_groups[image_id] in groups))
+            return array('q', result)
+
+
+_index = None
+
+def get_index():
+    return _index
+
+def build_index():
+    global _index
+    index = TagIndex()
+    index.load()
+    _index = index
+    return _index
@@ -0,0 +1,72 @@
+"""
+Sorted in-memory tag vocabulary for resolving keyword prefixes to tag IDs.
+Tags are compared in lowercase, so keywords are case-insensitive and characters like '_' and '%' match literally.
+"""
+import threading
+
+from bisect import bisect_left, bisect_right
+
+from .database import Tag, reader
+
+__author__ = 'Chronoes'
+
+
+class TagVocabulary:
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+        self.last_tag_id = 0
+        self.lock = threading.Lock()
+
+    def load(self, after_id=0):
+        """Loads tags with ID greater than after_id from the database"""
+        query = Tag.select(Tag.id, Tag.tag).where(Tag.id > after_id).bind(reader()).tuples()
+        with self.lock:
+            if not self.keys:
+                entries = sorted((tag.lower(), tag_id) for tag_id, tag in query.iterator())
+                self.keys = [key for key, _ in entries]
+                self.ids = [tag_id for _, tag_id in entries]
+            else:
+                for tag_id, tag in query.iterator():
+                    self._add(tag, tag_id)
+            if self.ids:
+                self.last_tag_id = max(self.last_tag_id, max(self.ids))
+
+    def refresh(self):
+        """Picks up tags inserted since the last load"""
+        last_id = Tag.select(Tag.id).order_by(Tag.id.desc()).limit(1).bind(reader()).scalar() or 0
+        if last_id > self.last_tag_id:
+            self.load(self.last_tag_id)
+
+    def _add(self, tag: str, tag_id: int):
+        key = tag.lower()
+        i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.ids.insert(i, tag_id)
+        self.last_tag_id = max(self.last_tag_id, tag_id)
+
+    def find_prefix(self, prefix: str) -> list:
+        prefix = prefix.lower()
+        with self.lock:
+            keys = self.keys
+            i = bisect_left(keys, prefix)
+            start = i
+            while i < len(keys) and keys[i].startswith(prefix):
+                i += 1
+            return self.ids[start:i]
+
+
+_vocabulary = None
+_vocabulary_lock = threading.Lock()
+
+def get_vocabulary():
+    """Returns the process-wide vocabulary, loading it on first use"""
+    global _vocabulary
+    with _vocabulary_lock:
+        if _vocabulary is None:
+            vocabulary = TagVocabulary()
+            vocabulary.load()
+            _vocabulary = vocabulary
+        else:
+            _vocabulary.refresh()
+    return _vocabulary
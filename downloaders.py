@@ -1,17 +1,55 @@
 """
 """
+import hashlib
+import json
+import os
+import queue
 import re
+import threading
+import time
+import uuid
 
-from requests import Session
+from requests import RequestException, Session
 from bs4 import BeautifulSoup
+from html.parser import HTMLParser as EventParser
 from urllib.parse import urljoin, urlparse, parse_qs
 
 from config import load_config
 
 __author__ = 'Chronoes'
 
+CHUNK_SIZE = 1024 * 1024
+
 class ImageDownloaderException(Exception): pass
 
+class PartialFile:
+    """
+    Hidden temporary file in the destination directory that downloaded chunks are written into.
+    Content hash is computed as chunks arrive, so the file does not have to be read again.
+    """
+    def __init__(self, directory):
+        # Not mkstemp, as its files are private to the user regardless of umask
+        self.path = os.path.join(directory, '.{}.part'.format(uuid.uuid4().hex))
+        self.file = open(self.path, 'xb')
+        self.hash = hashlib.sha256()
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.hash.update(chunk)
+
+    def content_hash(self) -> str:
+        return self.hash.hexdigest()
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path)
+
+
 class ImageDownloader:
     def __init__(self, session, url):
         self.session = session
@@ -27,17 +65,52 @@ class ImageDownloader:
         """
         raise NotImplementedError('Returns canonical URL')
 
-    def get_image_info(self):
+    def info_request(self):
+        """
+        Returns URL and query parameters for requesting image metadata
+        """
+        return self.url, None
+
+    def parse_image_info(self, text):
         """
         Must return dictionary containing 'tags' and 'link' keys
         """
-        raise NotImplementedError('Gets image metadata')
+        raise NotImplementedError('Parses image metadata')
+
+    def prefetched_info(self):
+        """
+        Returns metadata that was fetched ahead in a batch request, or None if it has to be requested
+        """
+        return None
+
+    def get_image_info(self):
+        info = self.prefetched_info()
+        if info is not None:
+            return info
+        url, params = self.info_request()
+        resp = self.session.get(url, params=params)
+        return self.parse_image_info(resp.text)
+
+    def download_headers(self):
+        return {'Referer': self.url}
 
-    def get_image(self, link):
-        resp = self.session.get(
-            link,
-            headers={'Referer': self.url})
-        return resp.content
+    def download_image(self, link, directory):
+        """
+        Streams image into a hidden temporary file in directory and returns (path, content hash).
+        The file is synced to disk, but it is up to the caller to move it to its final name.
+        """
+        with self.session.get(link, headers=self.download_headers(), stream=True) as resp:
+            if not resp.ok:
+                raise ImageDownloaderException('{}: Could not download {} ({})'.format(str(self), link, resp.status_code))
+            partial = PartialFile(directory)
+            try:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    partial.write(chunk)
+                partial.close()
+            except BaseException:
+                partial.discard()
+                raise
+        return partial.path, partial.content_hash()
 
     def __str__(self):
         return self.__class__.__name__
@@ -46,7 +119,9 @@ class ImageDownloader:
 def parse_gelbooru_id(url):
     parsed_url = urlparse(url)
     qry = parse_qs(parsed_url.query)
-    return qry['id'].pop()
+    if not qry.get('id'):
+        raise ImageDownloaderException('Cannot parse ID from ' + url)
+    return qry['id'][-1]
 
 
 def gelbooru_canonical_url(url):
@@ -56,10 +131,15 @@ def gelbooru_canonical_url(url):
 
 class GelbooruAPIParser(ImageDownloader):
     base_url = 'https://gelbooru.com/index.php'
-    def __init__(self, session, url, api_key, user_id):
+    # Most posts the API returns per page
+    batch_size = 100
+
+    def __init__(self, session, url, api_key, user_id, prefetched=None):
         super().__init__(session, url)
         self.api_key = api_key
         self.user_id = user_id
+        # Shared dictionary of post ID to metadata filled by DownloaderManager.prefetch
+        self.prefetched = prefetched if prefetched is not None else {}
 
     @staticmethod
     def supports(url):
@@ -68,43 +148,140 @@ class GelbooruAPIParser(ImageDownloader):
     def canonical_url(self):
         return gelbooru_canonical_url(self.url)
 
-    def upvote_image(self, img_id):
-        params={'page': 'post', 's': 'vote', 'id': img_id, 'type': 'up'}
-        self.session.get(self.base_url, params=params)
+    def upvote_request(self):
+        return self.base_url, {'page': 'post', 's': 'vote', 'id': parse_gelbooru_id(self.url), 'type': 'up'}
 
-    def get_image_info(self):
-        params = {'page': 'dapi', 's': 'post', 'q': 'index', 'json': 1, 'api_key': self.api_key, 'user_id': self.user_id}
-        img_id = parse_gelbooru_id(self.url)
-        params['id'] = img_id
-        resp = self.session.get(self.base_url, params=params)
-        if len(resp.content) == 0:
-            raise ImageDownloaderException('{}: Could not parse {}'.format(str(self), self.url))
-        resp_json = resp.json()
-        if not resp_json or 'post' not in resp_json:
-            raise ImageDownloaderException('{}: Could not parse {}'.format(str(self), self.url))
-        item = resp_json['post'].pop()
+    @classmethod
+    def api_request(cls, api_key, user_id, **params):
+        return cls.base_url, dict(
+            {'page': 'dapi', 's': 'post', 'q': 'index', 'json': 1, 'api_key': api_key, 'user_id': user_id}, **params)
 
-        self.upvote_image(img_id)
+    @classmethod
+    def batch_request(cls, api_key, user_id, ids: list, page=0):
+        """Request for posts with any of the IDs, which are matched with an {id:1 ~ id:2} tag search"""
+        tags = '{' + ' ~ '.join('id:' + post_id for post_id in ids) + '}'
+        return cls.api_request(api_key, user_id, tags=tags, limit=cls.batch_size, pid=page)
+
+    @staticmethod
+    def parse_posts(text) -> list:
+        """Returns the posts of an API response, raises ValueError if the response is not valid JSON"""
+        resp_json = json.loads(text) if text else None
+        if not isinstance(resp_json, dict):
+            return []
+        return resp_json.get('post', [])
 
+    @staticmethod
+    def post_info(item) -> dict:
         return {
             'tags': item['tags'].split(),
             'link': item['file_url']
         }
 
+    def prefetched_info(self):
+        return self.prefetched.pop(parse_gelbooru_id(self.url), None)
+
+    def info_request(self):
+        return self.api_request(self.api_key, self.user_id, id=parse_gelbooru_id(self.url))
+
+    def parse_image_info(self, text):
+        posts = self.parse_posts(text)
+        if not posts:
+            raise ImageDownloaderException('{}: Could not parse {}'.format(str(self), self.url))
+        return self.post_info(posts.pop())
+
+
+class _FoundAll(Exception): pass
+
+class PostPageExtractor(EventParser):
+    """
+    Pulls the tags (alt of the #image element) and the original image link out of a post page without building a
+    tree, and stops reading the page as soon as both are found.
+    Link is the href of the element with link_id, or of the first <a> whose only text is link_text.
+    """
+    def __init__(self, link_id=None, link_text=None):
+        super().__init__()
+        self.link_id = link_id
+        self.link_text = link_text
+        self.alt = None
+        self.href = None
+        self.image_seen = False
+        self.link_seen = False
+        # href and text of the <a> being read, when looking for the link by its text
+        self.anchor = None
+
+    @classmethod
+    def extract(cls, text, link_id=None, link_text=None):
+        """Returns (alt, href) with None for what was not found"""
+        extractor = cls(link_id, link_text)
+        try:
+            extractor.feed(text)
+            extractor.close()
+        except _FoundAll:
+            pass
+        return extractor.alt, extractor.href
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        element_id = attrs.get('id')
+        if element_id == 'image' and not self.image_seen:
+            self.image_seen = True
+            self.alt = attrs.get('alt')
+        if self.link_id and element_id == self.link_id and not self.link_seen:
+            self.link_seen = True
+            self.href = attrs.get('href')
+        if self.link_text and tag == 'a' and not self.link_seen:
+            self.anchor = (attrs.get('href'), [])
+        self._check_done()
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag == 'a':
+            self.handle_endtag(tag)
+
+    def handle_data(self, data):
+        if self.anchor is not None:
+            self.anchor[1].append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.anchor is not None:
+            href, text = self.anchor
+            self.anchor = None
+            if ''.join(text) == self.link_text:
+                self.link_seen = True
+                self.href = href
+                self._check_done()
+
+    def _check_done(self):
+        if self.image_seen and self.link_seen:
+            raise _FoundAll()
+
 
 class HTMLParser(ImageDownloader):
-    def get_image_info(self):
-        resp = self.session.get(self.url)
-        soup = BeautifulSoup(resp.text, 'html.parser')
+    # Finds the original image link by id or by link text for PostPageExtractor
+    link_id = None
+    link_text = None
+
+    def parse_image_info(self, text):
+        alt, href = PostPageExtractor.extract(text, link_id=self.link_id, link_text=self.link_text)
+        if alt is not None and href:
+            return self._image_info(alt, href)
+        # Pages the extractor does not understand go through the full parse
+        return self.parse_image_info_soup(text)
+
+    def parse_image_info_soup(self, text):
+        soup = BeautifulSoup(text, 'html.parser')
         image_parent = self._get_image_parent(soup)
         link_parent = self._get_link_parent(soup)
         if image_parent and link_parent:
-            return {
-                'tags': image_parent['alt'].split(),
-                'link': urljoin(self.url, link_parent['href']) if link_parent['href'].startswith('//') else link_parent['href']
-            }
+            return self._image_info(image_parent['alt'], link_parent['href'])
         raise ImageDownloaderException('{}: Could not parse {}'.format(str(self), self.url))
 
+    def _image_info(self, alt, href):
+        return {
+            'tags': alt.split(),
+            'link': urljoin(self.url, href) if href.startswith('//') else href
+        }
+
     def _get_image_parent(self, soup):
         raise NotImplementedError('Gets location of image and tags in HTML')
 
@@ -113,6 +290,8 @@ class HTMLParser(ImageDownloader):
 
 
 class GelbooruParser(HTMLParser):
+    link_text = 'Original image'
+
     @staticmethod
     def supports(url):
         return 'gelbooru.com' in url
@@ -126,23 +305,17 @@ class GelbooruParser(HTMLParser):
     def _get_link_parent(self, soup):
         a_tags = soup.find_all('a')
         for element in a_tags:
-            if element.string == 'Original image':
+            if element.string == self.link_text:
                 return element
         return ''
 
-    def upvote_image(self, img_id):
-        params={'page': 'post', 's': 'vote', 'id': img_id, 'type': 'up'}
-        self.session.get('https://gelbooru.com/index.php', params=params)
+    def upvote_request(self):
+        return GelbooruAPIParser.base_url, {'page': 'post', 's': 'vote', 'id': parse_gelbooru_id(self.url), 'type': 'up'}
 
-    def get_image_info(self):
-        result = super().get_image_info()
-        if result:
-            img_id = parse_gelbooru_id(self.url)
-            self.upvote_image(img_id)
-        return result
 
 class KonachanParser(HTMLParser):
     host = 'konachan.com'
+    link_id = 'highres'
 
     @staticmethod
     def supports(url):
@@ -158,7 +331,7 @@ class KonachanParser(HTMLParser):
         return soup.find(id='image')
 
     def _get_link_parent(self, soup):
-        return soup.find(id='highres')
+        return soup.find(id=self.link_id)
 
 
 class YandereParser(KonachanParser):
@@ -169,28 +342,35 @@ class YandereParser(KonachanParser):
         return YandereParser.host in url
 
 class ImageInfo:
-    def __init__(self, link: str, original_link: str, tags: list[str], group=None, downloader: ImageDownloader=None, data=None, parent=None, filename=None) -> None:
+    def __init__(self, link: str, original_link: str, tags: list[str], group=None, downloader: ImageDownloader=None, path=None, parent=None, filename=None, content_hash=None) -> None:
         self.link = link
         self.original_link = original_link
         self.tags = tags
         self.group = group
-        self.data = data
+        # Temporary file holding the downloaded image
+        self.path = path
         self.downloader = downloader
         self.parent = parent
         self.filename = filename
+        # SHA-256 of the downloaded file
+        self.content_hash = content_hash
+        # ID of the saved image row
+        self.id = None
 
     @classmethod
-    def from_downloader(cls, downloader: ImageDownloader, group=None, skip_data=False, parent=None):
+    def from_downloader(cls, downloader: ImageDownloader, group=None, skip_data=False, parent=None, directory=None):
         img_info = downloader.get_image_info()
+        path, content_hash = (None, None) if skip_data else downloader.download_image(img_info['link'], directory)
         return cls(img_info['link'], downloader.canonical_url(), img_info['tags'], group=group, downloader=downloader,
-            data=None if skip_data else downloader.get_image(img_info['link']),
-            parent=parent)
+            path=path, parent=parent, content_hash=content_hash)
 
 class DownloaderManager:
     def __init__(self):
         self.config = load_config()
         self.session = Session()
         self.config_verified = {'gelbooru': self._verify_gelbooru_api_config()}
+        # Gelbooru post ID to metadata, handed out to the downloaders of the posts
+        self.prefetched = {}
 
     def _verify_gelbooru_api_config(self) -> bool:
         if 'credentials' not in self.config:
@@ -206,7 +386,8 @@ class DownloaderManager:
     def determine_downloader(self, url: str) -> ImageDownloader:
         if GelbooruAPIParser.supports(url) and self.config_verified['gelbooru']:
             credentials = self.config_verified['gelbooru']
-            return GelbooruAPIParser(self.session, url, credentials['api_key'], credentials['user_id'])
+            return GelbooruAPIParser(self.session, url, credentials['api_key'], credentials['user_id'],
+                prefetched=self.prefetched)
         elif GelbooruParser.supports(url):
             return GelbooruParser(self.session, url)
         elif KonachanParser.supports(url):
@@ -215,3 +396,126 @@ class DownloaderManager:
             return YandereParser(self.session, url)
 
         raise NotImplementedError('Parser for (' + url + ') does not exist yet')
+
+    def prefetch_batches(self, urls) -> list:
+        """
+        Groups IDs of Gelbooru posts among urls into lists for prefetch requests.
+        Empty if the API is not configured, as the HTML pages can only be fetched one by one.
+        """
+        if not self.config_verified['gelbooru']:
+            return []
+        ids = []
+        for url in urls:
+            if GelbooruAPIParser.supports(url):
+                try:
+                    post_id = parse_gelbooru_id(url)
+                except ImageDownloaderException:
+                    continue
+                if post_id not in self.prefetched and post_id not in ids:
+                    ids.append(post_id)
+        return [ids[i:i + GelbooruAPIParser.batch_size] for i in range(0, len(ids), GelbooruAPIParser.batch_size)]
+
+    def prefetch_request(self, ids: list, page=0):
+        credentials = self.config_verified['gelbooru']
+        return GelbooruAPIParser.batch_request(credentials['api_key'], credentials['user_id'], ids, page=page)
+
+    def store_prefetched(self, ids: list, text) -> bool:
+        """
+        Stores posts from a prefetch response, returns True if the next page may have more of the IDs.
+        Raises ImageDownloaderException if the response cannot be parsed.
+        """
+        try:
+            posts = GelbooruAPIParser.parse_posts(text)
+            for item in posts:
+                self.prefetched[str(item['id'])] = GelbooruAPIParser.post_info(item)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise ImageDownloaderException('Could not parse Gelbooru posts {}'.format(', '.join(ids)))
+        return len(posts) >= GelbooruAPIParser.batch_size and any(post_id not in self.prefetched for post_id in ids)
+
+    def prefetch(self, urls):
+        """
+        Fetches metadata of Gelbooru posts among urls with as few API requests as possible.
+        Posts that fail or are left out are requested one by one by their downloaders as usual.
+        """
+        for ids in self.prefetch_batches(urls):
+            page = 0
+            while True:
+                url, params = self.prefetch_request(ids, page)
+                try:
+                    more = self.store_prefetched(ids, self.session.get(url, params=params).text)
+                except (ImageDownloaderException, RequestException):
+                    break
+                if not more:
+                    break
+                page += 1
+
+
+class UpvoteQueue:
+    """
+    Sends upvotes of downloaded posts from a background thread, so they do not hold up downloading.
+    Requests are rate limited and retried with backoff when they fail or the site is throttling.
+    Call flush, or use as a context manager, to wait for the queued upvotes to be sent.
+    """
+    def __init__(self, rate=None, retries=None):
+        download_config = load_config().get('download', {})
+        self.interval = 1 / (rate or download_config.get('upvote_rate', 4))
+        self.retries = retries if retries is not None else download_config.get('upvote_retries', 3)
+        self.session = Session()
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_request = 0
+
+    def put(self, downloader: ImageDownloader):
+        """Queues upvote of the downloader's post, downloaders of sites without upvotes are ignored"""
+        if not hasattr(downloader, 'upvote_request'):
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._drain, daemon=True)
+                self.thread.start()
+        self.queue.put((str(downloader), downloader.upvote_request()))
+
+    def flush(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None:
+                return
+            self.queue.put(None)
+        thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, (url, params) = item
+            self._send(name, url, params)
+
+    def _wait(self, seconds):
+        time.sleep(max(0, self.last_request + seconds - time.monotonic()))
+        self.last_request = time.monotonic()
+
+    def _send(self, name, url, params):
+        delay = self.interval
+        for _ in range(self.retries + 1):
+            self._wait(delay)
+            retry_after = ''
+            try:
+                resp = self.session.get(url, params=params)
+            except RequestException as e:
+                error = repr(e)
+            else:
+                if resp.status_code != 429 and resp.status_code < 500:
+                    return
+                error = 'status {}'.format(resp.status_code)
+                retry_after = resp.headers.get('Retry-After', '')
+            # Backs off exponentially from a second, or as long as the site asks
+            delay = max(delay * 2, 1, int(retry_after) if retry_after.isdigit() else 0)
+        print('{}: Upvote of post {} failed: {}'.format(name, params.get('id'), error))
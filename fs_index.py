@@ -0,0 +1,79 @@
+"""
+Cached index of the files in group directories.
+Index of a directory is kept on disk and reused while the directory's modification time stays the same. A changed
+directory is listed and its files are stat'ed again.
+"""
+import hashlib
+import json
+import os
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from config import load_config
+
+__author__ = 'Chronoes'
+
+config = load_config()
+
+INDEX_PATH = config.get('fs_index', {}).get('path') or os.path.join(os.path.dirname(__file__), 'cache', 'fs_index')
+# Directory changed this recently may change again within the same modification time, so its index is not trusted
+RACY_SECONDS = 2
+# Indexes written in another format are scanned again
+INDEX_VERSION = 2
+
+FileInfo = namedtuple('FileInfo', ['size', 'mtime_ns'])
+
+
+def _index_file(directory: str) -> str:
+    return os.path.join(INDEX_PATH, hashlib.sha1(os.path.abspath(directory).encode()).hexdigest() + '.json')
+
+
+def _load_index(directory: str) -> dict:
+    try:
+        with open(_index_file(directory)) as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (FileNotFoundError, ValueError):
+        pass
+    return {'version': INDEX_VERSION, 'mtime_ns': None, 'entries': {}}
+
+
+def _save_index(directory: str, index: dict):
+    os.makedirs(INDEX_PATH, exist_ok=True)
+    path = _index_file(directory)
+    temp_path = '{}.{}.part'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+def scan_directory(directory: str) -> dict:
+    """Returns dictionary of filename to FileInfo, hidden files like partial downloads are left out"""
+    index = _load_index(directory)
+    mtime_ns = os.stat(directory).st_mtime_ns
+    if index['mtime_ns'] != mtime_ns:
+        entries = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                # Files can be rewritten in place, so a known name or inode does not mean the cached stat is good
+                stat = entry.stat()
+                entries[entry.name] = [stat.st_size, stat.st_mtime_ns]
+
+        racy = time.time_ns() - mtime_ns < RACY_SECONDS * 10 ** 9
+        index = {'version': INDEX_VERSION, 'mtime_ns': None if racy else mtime_ns, 'entries': entries}
+        _save_index(directory, index)
+
+    return {name: FileInfo(*info) for name, info in index['entries'].items()}
+
+
+def scan_groups(directories: dict) -> dict:
+    """Scans group directories in parallel, returns dictionary of group name to scan_directory result"""
+    unique_directories = set(directories.values())
+    with ThreadPoolExecutor(max(1, min(len(unique_directories), 8))) as executor:
+        scanned = dict(zip(unique_directories, executor.map(scan_directory, unique_directories)))
+    return {group: scanned[directory] for group, directory in directories.items()}
@@ -0,0 +1,102 @@
+"""
+Consistency check between the database and the group directories.
+Directories are read through the cached fs_index, so repeated checks only list directories that changed. Database
+rows are streamed, but the indexes of all checked directories are held for the whole run, along with the files no row
+has claimed and the rows whose file is missing, as files misplaced in another group's directory can only be told
+apart from orphans once every row has been seen.
+"""
+import os
+import peewee
+
+import database.database as db
+import fs_index
+
+from database.db_queries import get_groups
+from config import load_config
+
+__author__ = 'Chronoes'
+
+config = load_config()
+
+
+def find_untagged(group: db.ImageGroup=None):
+    query = db.Image.select(db.Image.id, db.Image.filename) \
+        .where(~peewee.fn.EXISTS(db.ImageTag.select().where(db.ImageTag.image == db.Image.id))) \
+        .tuples()
+    if group:
+        query = query.where(db.Image.group == group)
+    return query.iterator()
+
+
+def find_broken_parents(group: db.ImageGroup=None):
+    Parent = db.Image.alias()
+    query = db.Image.select(db.Image.id, db.Image.filename, db.Image.parent) \
+        .join(Parent, peewee.JOIN.LEFT_OUTER, on=(db.Image.parent == Parent.id)) \
+        .where(db.Image.parent.is_null(False) & Parent.id.is_null()) \
+        .tuples()
+    if group:
+        query = query.where(db.Image.group == group)
+    return query.iterator()
+
+
+def check(group: db.ImageGroup=None, report=print) -> dict:
+    """Reports every inconsistency through report, returns dictionary of problem to count"""
+    counts = dict.fromkeys(
+        ('unconfigured groups', 'missing files', 'misplaced files', 'orphan files', 'size mismatches',
+        'untagged images', 'broken parents'), 0)
+
+    groups = [group] if group else list(get_groups())
+    for g in groups:
+        if g.name not in config['groups']:
+            report('Group {} has no directory configured'.format(g.name))
+            counts['unconfigured groups'] += 1
+    directories = {g.name: config['groups'][g.name] for g in groups if g.name in config['groups']}
+    files = fs_index.scan_groups(directories)
+
+    # Files of a directory that no row has claimed yet, groups can share a directory
+    unclaimed = {directory: set(files[name]) for name, directory in directories.items()}
+    missing = {}
+    query = db.Image.select(db.Image.id, db.Image.filename, db.Image.size, db.ImageGroup.name) \
+        .join(db.ImageGroup) \
+        .where(db.ImageGroup.name << list(directories)) \
+        .tuples()
+    if group:
+        query = query.where(db.Image.group == group)
+    for image_id, filename, size, group_name in query.iterator():
+        file_info = files[group_name].get(filename)
+        if file_info is None:
+            missing[filename] = (image_id, group_name)
+            continue
+        unclaimed[directories[group_name]].discard(filename)
+        if size is not None and size != file_info.size:
+            report('Image {} ({}) is {} bytes in the database, but its file is {} bytes'.format(
+                image_id, filename, size, file_info.size))
+            counts['size mismatches'] += 1
+
+    for directory, filenames in unclaimed.items():
+        for filename in sorted(filenames):
+            if filename in missing:
+                image_id, group_name = missing.pop(filename)
+                report('Image {} ({}) is in group {}, but its file is in {}'.format(
+                    image_id, filename, group_name, directory))
+                counts['misplaced files'] += 1
+            else:
+                report('File {} is not in the database'.format(os.path.join(directory, filename)))
+                counts['orphan files'] += 1
+    for filename, (image_id, group_name) in sorted(missing.items(), key=lambda item: item[1]):
+        report('Image {} ({}) of group {} has no file'.format(image_id, filename, group_name))
+        counts['missing files'] += 1
+
+    for image_id, filename in find_untagged(group):
+        report('Image {} ({}) has no tags'.format(image_id, filename))
+        counts['untagged images'] += 1
+    for image_id, filename, parent_id in find_broken_parents(group):
+        report('Image {} ({}) links to parent {}, which does not exist'.format(image_id, filename, parent_id))
+        counts['broken parents'] += 1
+    return counts
+
+
+def run(group: db.ImageGroup=None):
+    counts = check(group)
+    print(', '.join('{} {}'.format(count, problem) for problem, count in counts.items()))
+    return sum(counts.values()) == 0
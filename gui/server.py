@@ -1,18 +1,49 @@
+import json
 import mimetypes
 import os
 import os.path
 import shutil
+
 import peewee
 
 import imagedb.database.database as db
-
-from imagedb.database.db_queries import query_results, find_group, get_groups, get_image_tags, query_by_id
-from flask import Flask, render_template, request, send_from_directory, url_for
+import imagedb.database.tag_index as tag_index
+import imagedb.thumbnails as thumbnails
+
+from imagedb.database.db_queries import (count_results, get_groups, get_image_tag_ids, get_tags_by_image, query_by_id,
+    query_results, random_results, with_tags)
+from flask import Flask, Response, abort, jsonify, render_template, request, send_file, send_from_directory, \
+    stream_with_context, url_for
+from werkzeug.security import safe_join
 from imagedb.config import load_config
 
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Rows of a streamed search are sent in chunks, with the tags of a chunk fetched together
+STREAM_CHUNK_SIZE = 200
+
 app = Flask(__name__)
 config = load_config()
+# Saved files do not change under their name, so browsers can keep them without revalidating
+FILE_MAX_AGE = config.get('server', {}).get('file_max_age', 365 * 24 * 60 * 60)
 db.connect_db()
+db.use_read_pool()
+if config.get('search', {}).get('engine') == 'memory':
+    tag_index.build_index()
+# Requests get their own connections
+db.reader().close()
+db.db.close()
+
+@app.before_request
+def connect_database():
+    db.reader().connect(reuse_if_open=True)
+
+@app.teardown_request
+def close_database(exc):
+    # Writer connection is only opened by requests that modify images
+    for database in (db.reader(), db.db):
+        if not database.is_closed():
+            database.close()
 
 @app.context_processor
 def override_url_for():
@@ -42,21 +73,77 @@ def index():
         defaults['randomize'] = randomize
     if keywords or randomize == '1':
         defaults['qt'] = request.args.get('qt', defaults['qt'])
+        limit = limit_arg(PAGE_SIZE, MAX_PAGE_SIZE)
         results = []
-        query = query_results(keywords.split() if len(keywords) > 0 else [], groups=request.args.getlist('ig[]'), query_type=defaults['qt'])
+        split_line = keywords.split() if keywords else []
         if randomize == '1':
-            query = query.order_by(peewee.fn.Random())
+            query = random_results(split_line, groups=request.args.getlist('ig[]'), query_type=defaults['qt'],
+                count=limit)
+        else:
+            query = query_results(split_line, groups=request.args.getlist('ig[]'), query_type=defaults['qt'],
+                after=request.args.get('after', type=int), limit=limit)
 
-        if len(keywords) == 0:
-            query = query.limit(100)
-        for image in query:
+        for image, tags in with_tags(query):
             (mimetype, _) = mimetypes.guess_type(image.filename)
-            results.append((image, mimetype, ' '.join(get_image_tags(image))))
+            results.append((image, mimetype, ' '.join(tags)))
+
+        if randomize != '1' and len(results) == limit:
+            args = request.args.to_dict(flat=False)
+            args['after'] = results[-1][0].id
+            defaults['next_page'] = url_for('index', **args)
 
         return render_template('index.html', results=results, **defaults)
 
     return render_template('index.html', **defaults)
 
+def limit_arg(default=None, maximum=None):
+    """Returns limit parameter clamped to at least 1, as SQLite takes a negative limit as no limit at all"""
+    limit = request.args.get('limit', default, type=int)
+    if limit is None:
+        return None
+    limit = max(1, limit)
+    return min(limit, maximum) if maximum is not None else limit
+
+def search_args():
+    keywords = request.args.get('keywords')
+    split_line = keywords.split() if keywords else []
+    return split_line, request.args.getlist('ig[]'), request.args.get('qt', 'keyword')
+
+def image_json(image, tags):
+    (mimetype, _) = mimetypes.guess_type(image.filename)
+    return {
+        'id': image.id,
+        'filename': image.filename,
+        'group': image.group.name,
+        'mimetype': mimetype,
+        'original_link': image.original_link,
+        'url': url_for('image_file', group=image.group.name, filename=image.filename),
+        'tags': tags
+    }
+
+@app.route('/api/search')
+def api_search():
+    """
+    Streams matching images newest first as newline delimited JSON, while they are read from the database.
+    Takes the same parameters as the gallery, pages by passing the ID of the last image as after.
+    """
+    split_line, groups, query_type = search_args()
+    query = query_results(split_line, groups=groups, query_type=query_type,
+        after=request.args.get('after', type=int), limit=limit_arg())
+
+    def generate():
+        for images in peewee.chunked(query.iterator(), STREAM_CHUNK_SIZE):
+            tags = get_tags_by_image([image.id for image in images])
+            yield ''.join(json.dumps(image_json(image, tags[image.id])) + '\n' for image in images)
+
+    # Request context, and with it the database connection, stays open until the last row is sent
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/search/count')
+def api_search_count():
+    split_line, groups, query_type = search_args()
+    return jsonify(count=count_results(split_line, groups=groups, query_type=query_type))
+
 @app.route('/image/<int:image_id>', methods=['PUT', 'DELETE'])
 def image(image_id):
     if request.method == 'PUT':
@@ -76,11 +163,25 @@ def image(image_id):
                     shutil.move(image_path, new_directory)
                 image.group = new_group
 
-        image.save()
+        with db.db.atomic():
+            image.generation = db.bump_generation()
+            image.save()
+
+        index = tag_index.get_index()
+        if index is not None:
+            index.set_image_group(image.id, image.group_id)
     if request.method == 'DELETE':
         image = query_by_id([image_id]).pop()
+        index = tag_index.get_index()
+        tag_ids = get_image_tag_ids(image) if index is not None else None
+
+        with db.db.atomic():
+            db.ImageTag.delete().where(db.ImageTag.image == image).execute()
+            image.delete_instance()
+            db.bump_generation()
 
-        image.delete_instance()
+        if index is not None:
+            index.remove_image(image.id, tag_ids)
 
         directory = config['groups'][image.group.name]
         try:
@@ -90,10 +191,41 @@ def image(image_id):
 
     return 'success'
 
+group_directories = {}
+
+def group_directory(group: str) -> str:
+    """Returns directory of group by name, the database is only asked for names that are not cached yet"""
+    if group not in group_directories:
+        group_directories.update((g.name, config['groups'].get(g.name)) for g in get_groups())
+    directory = group_directories.get(group)
+    if directory is None:
+        abort(404)
+    return directory
+
+def file_response(response):
+    response.cache_control.immutable = True
+    # Lets video players seek with Range requests from the start
+    response.accept_ranges = 'bytes'
+    return response
+
+@app.route('/thumb/<group>/<path:filename>')
+def thumbnail_file(group, filename):
+    source = safe_join(group_directory(group), filename)
+    if source is None:
+        abort(404)
+    content_hash = db.Image.select(db.Image.content_hash) \
+        .where(db.Image.filename == filename) \
+        .bind(db.reader()) \
+        .scalar()
+
+    path = thumbnails.get_thumbnail(source, content_hash)
+    if path is None:
+        # Gallery falls back to the full file
+        abort(404)
+    return file_response(send_file(path, mimetype='image/jpeg', etag=True, max_age=FILE_MAX_AGE))
+
 @app.route('/<group>/<path:filename>')
 def image_file(group, filename):
-    db_group = find_group(group)
-    if db_group:
-        directory = config['groups'][db_group.name]
-        return send_from_directory(directory, filename)
-    return None
+    # Conditional requests get 304 by ETag or Last-Modified, Range requests get 206 with only the requested bytes.
+    # ETag has to be asked for, as Flask would otherwise turn it off
+    return file_response(send_from_directory(group_directory(group), filename, etag=True, max_age=FILE_MAX_AGE))
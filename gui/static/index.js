@@ -7,8 +7,7 @@
     dimensionsEl.textContent = dimensions;
   };
 
-  document.querySelectorAll('.lazy.lazyloading').forEach((el) => {
-    console.log(el);
+  const watchDimensions = (el) => {
     if (el.localName === 'video') {
       if (el.videoWidth) {
         setDimensions(el, `${el.videoWidth}x${el.videoHeight}`);
@@ -17,14 +16,31 @@
         setDimensions(el, `${el.videoWidth}x${el.videoHeight}`);
       });
     } else {
+      // Dimensions of a thumbnail are not the dimensions of the image, they are set once the full file is loaded
+      const onLoad = () => {
+        if (el.dataset.full) {
+          el.classList.remove('lazyloading');
+        } else {
+          setDimensions(el, `${el.naturalWidth}x${el.naturalHeight}`);
+        }
+      };
       if (el.naturalWidth) {
-        setDimensions(el, `${el.naturalWidth}x${el.naturalHeight}`);
+        onLoad();
       }
-      el.addEventListener('load', (event) => {
-        setDimensions(el, `${el.naturalWidth}x${el.naturalHeight}`);
-      });
+      el.addEventListener('load', onLoad);
+      // No thumbnail could be made, show the full file instead
+      el.addEventListener('error', (event) => loadFullImage(el), { once: true });
     }
-  });
+  };
+
+  const loadFullImage = (el) => {
+    if (el.dataset.full) {
+      el.src = el.dataset.full;
+      delete el.dataset.full;
+    }
+  };
+
+  document.querySelectorAll('.lazy.lazyloading').forEach(watchDimensions);
 
   function removeChildren(element) {
     while (element.lastChild) {
@@ -99,7 +115,11 @@
 
       imageUrl.href = mainImg.dataset['original-link'];
 
-      const actualSource = mainImg.querySelector('img') ?? mainImg.querySelector('source');
+      const img = mainImg.querySelector('img');
+      if (img) {
+        loadFullImage(img);
+      }
+      const actualSource = img ?? mainImg.querySelector('source');
       imageLocal.href = actualSource.src;
       const pathComponents = actualSource.src.split('/');
       imageLocal.textContent = pathComponents[pathComponents.length - 1];
@@ -124,11 +144,39 @@
     };
   })();
 
-  document.querySelectorAll('.results .image').forEach((image) => {
+  const bindResult = (image) => {
     image.addEventListener('click', (event) => {
       setCurrentImage(image);
     });
-  });
+  };
+
+  document.querySelectorAll('.results .image').forEach(bindResult);
+
+  const nextPageLink = document.getElementById('next-page');
+  if (nextPageLink) {
+    // Append the next page of results in place, the link itself works as plain pagination
+    nextPageLink.addEventListener('click', (event) => {
+      event.preventDefault();
+      fetch(nextPageLink.href)
+        .then((res) => res.text())
+        .then((html) => {
+          const page = new DOMParser().parseFromString(html, 'text/html');
+          const resultsRow = document.querySelector('.results .row');
+          page.querySelectorAll('.results .image').forEach((image) => {
+            resultsRow.appendChild(image);
+            image.querySelectorAll('.lazy.lazyloading').forEach(watchDimensions);
+            bindResult(image);
+          });
+
+          const pageNextLink = page.getElementById('next-page');
+          if (pageNextLink) {
+            nextPageLink.href = pageNextLink.getAttribute('href');
+          } else {
+            nextPageLink.parentElement.removeChild(nextPageLink);
+          }
+        });
+    });
+  }
 
   document.querySelectorAll('.btn > [type="checkbox"]').forEach((element) => {
     element.addEventListener('change', (event) => {
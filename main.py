@@ -6,12 +6,16 @@ import peewee
 
 import database.db_queries as queries
 
-from main_functions import fetch_image_urls, get_image, get_image_bulk, process_tags, save, save_file
+from main_functions import BatchWriter, backfill_hashes, build_thumbnails, fetch_image_urls, get_image, get_image_bulk, process_tags, save, \
+    save_redownloaded
 from database.database import connect_db
-from downloaders import DownloaderManager
+from downloaders import DownloaderManager, UpvoteQueue
+from config import load_config
 
 __author__ = 'Chronoes'
 
+config = load_config()
+
 
 
 def init_parser():
@@ -32,55 +36,81 @@ def init_parser():
         help='Apply some force.')
     parser.add_argument('-g', '--group',
         help='Group to be used for image')
+    parser.add_argument('--backfill-hashes',
+        action='store_true',
+        help='Hash and measure files of images saved before content hashing, in --group or all groups.')
+    parser.add_argument('--thumbnails',
+        action='store_true',
+        help='Generate missing gallery thumbnails for images in --group or all groups.')
+    parser.add_argument('--fsck',
+        action='store_true',
+        help='Check images in --group or all groups against their files, exits with 1 if problems are found.')
+    parser.add_argument('--engine',
+        help='Download engine for bulk downloads, asyncio requires aiohttp from requirements-async.txt. '
+            'Defaults to download.engine in config.',
+        choices=('threads', 'asyncio'))
     parser.add_argument('source', nargs='?', default='-',
         help='Source must be a valid URL or file of URLs')
     return parser
 
 
+def get_bulk_downloader(engine):
+    if engine == 'asyncio':
+        from async_engine import get_image_bulk as get_image_bulk_async
+        return get_image_bulk_async
+    return get_image_bulk
+
+
 def main():
     parser = init_parser()
     args = parser.parse_args()
     connect_db()
+    image_bulk = get_bulk_downloader(args.engine or config.get('download', {}).get('engine'))
 
     try:
         img_group = queries.find_group(args.group) if args.group else None
     except peewee.DoesNotExist as e:
         raise Exception(f'No such image group {args.group}') from e
 
-    if args.redownload == 'images':
+    if args.fsck:
+        import fsck
+        sys.exit(0 if fsck.run(img_group) else 1)
+    elif args.backfill_hashes:
+        backfill_hashes(img_group)
+    elif args.thumbnails:
+        build_thumbnails(img_group)
+    elif args.redownload == 'images':
         urls = fetch_image_urls(img_group, args.force)
         def redownload_images_cb(result, error=False):
             if error:
                 print(result)
             else:
-                save_file(result)
-                print(f'Image {result["original_link"]} redownloaded.')
+                save_redownloaded(result)
+                print(f'Image {result.original_link} redownloaded.')
 
-        get_image_bulk(urls, redownload_images_cb, redownload=True)
+        image_bulk(urls, redownload_images_cb, redownload=True)
     elif args.redownload == 'metadata':
         urls = fetch_image_urls(img_group, True)
         def redownload_metadata_cb(result, error=False):
             if error:
                 print(result)
             else:
-                img = queries.find_by_filename(result['filename'])
-                process_tags(img, result['tags'])
-                print(f'Image {result["filename"]} ({result["original_link"]}) metadata redownloaded.')
+                img = queries.find_by_filename(result.filename)
+                process_tags(img, result.tags)
+                print(f'Image {result.filename} ({result.original_link}) metadata redownloaded.')
 
-        get_image_bulk(urls, redownload_metadata_cb, redownload=True, skip_data=True)
+        # Posts were already upvoted when they were first downloaded
+        image_bulk(urls, redownload_metadata_cb, redownload=True, skip_data=True, upvote=False)
     elif args.source.startswith('http'):
         if img_group is None:
             raise Exception('--group option must be specified for HTTP link as source')
         manager = DownloaderManager()
         downloader = manager.determine_downloader(args.source)
-        if 'out' in args:
-            img_info = get_image(downloader, custom_name=args.out)
+        with UpvoteQueue() as upvotes:
+            img_info = get_image(downloader, img_group.name, custom_name=args.out, upvotes=upvotes)
+        if type(img_info) == tuple:
+            print(img_info[0])
         else:
-            img_info = get_image(downloader)
-        if type(img_info) == str:
-            print(img_info)
-        else:
-            img_info['group'] = img_group.name
             save(img_info)
     else:
         file = sys.stdin if args.source == '-' else open(args.source, 'r')
@@ -101,13 +131,8 @@ def main():
                         urls.append(tuple(parts))
 
 
-        def save_image_cb(result, error=False):
-            if error:
-                print(result)
-            else:
-                save(result)
-
-        get_image_bulk(urls, save_image_cb, redownload=bool(args.redownload))
+        with BatchWriter() as writer:
+            image_bulk(urls, writer, redownload=bool(args.redownload))
 
 
 if __name__ == '__main__':
@@ -1,132 +1,387 @@
-import concurrent.futures as confut
+import os
 import threading
+import time
 import queue
 import peewee
 import progressbar
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from requests import RequestException
 
 import database.database as db
+import database.tag_index as tag_index
+import fs_index
 import utilities as util
-from database.db_queries import find_group, get_groups
-from downloaders import ImageDownloader, DownloaderManager, ImageDownloaderException, ImageInfo
+from database.db_queries import MAX_QUERY_PARAMS, find_content_hashes, find_group, find_original_links, get_groups, \
+    get_image_tag_ids
+from database.tag_cache import tag_cache
+from downloaders import ImageDownloader, DownloaderManager, GelbooruAPIParser, ImageDownloaderException, ImageInfo, \
+    UpvoteQueue
 
 from config import load_config
 
 config = load_config()
 
 
-def get_image(downloader: ImageDownloader, group: str, redownload=False, custom_name=None, skip_data=False, parent=None):
+def get_image(downloader: ImageDownloader, group: str, redownload=False, custom_name=None, skip_data=False, parent=None,
+        upvotes: UpvoteQueue=None):
+    img_info = get_image_metadata(downloader, group, parent=parent, upvotes=upvotes)
+    if type(img_info) == tuple:
+        return img_info
+    # Filename is known from metadata, so existing images are not downloaded at all
+    img_info = name_image(img_info, redownload=redownload, custom_name=custom_name)
+    if type(img_info) == tuple or skip_data:
+        return img_info
+    return get_image_data(img_info)
+
+
+def get_image_metadata(downloader: ImageDownloader, group: str, parent=None, upvotes: UpvoteQueue=None):
+    if group not in config['groups']:
+        return ('{}: No directory configured for group {}'.format(downloader, group), downloader.canonical_url())
     try:
-        img_info = ImageInfo.from_downloader(downloader, group=group, skip_data=skip_data, parent=parent)
+        img_info = ImageInfo.from_downloader(downloader, group=group, skip_data=True, parent=parent)
     except ImageDownloaderException as e:
         return (str(e), downloader.canonical_url())
+    except RequestException as e:
+        return ('{}: Request for {} failed: {!r}'.format(downloader, downloader.url, e), downloader.canonical_url())
+    if upvotes is not None:
+        upvotes.put(downloader)
+    return img_info
+
+
+def get_image_data(img_info: ImageInfo):
+    downloader = img_info.downloader
+    try:
+        img_info.path, img_info.content_hash = downloader.download_image(img_info.link, config['groups'][img_info.group])
+    except ImageDownloaderException as e:
+        return (str(e), img_info.original_link)
+    except RequestException as e:
+        return ('{}: Request for {} failed: {!r}'.format(downloader, img_info.link, e), img_info.original_link)
+    return img_info
+
+
+def name_image(img_info: ImageInfo, redownload=False, custom_name=None):
+    """Sets filename for image from its metadata, returns error tuple if the image already exists"""
+    downloader = img_info.downloader
     if custom_name:
         filename = custom_name + util.parse_extension(img_info.link)
     else:
         filename = util.parse_filename(img_info.link)
     if not redownload and db.Image.select().where(db.Image.filename == filename).exists():
+        discard_file(img_info)
         return ('{}: Image ({}) already exists'.format(downloader, downloader.url), downloader.canonical_url())
 
     img_info.filename = filename
     return img_info
 
 
-def queue_consumer(queue: queue.Queue, url_count: int, results_callback):
+def iter_url_jobs(urls: list):
+    """
+    Yields (group, url, parent) for every unique URL in the list.
+    URLs between 'series' and 'end series' lines get the previous URL of the series as their parent.
+    """
+    downloaded_urls = set()
+    series_of_urls = []
+    add_to_series = False
+    for group, url in urls:
+        url = url.strip()
+        if url in downloaded_urls:
+            continue
+        if url == 'series':
+            # start of a series of URLs, process separately
+            add_to_series = True
+        elif url == 'end series':
+            # ends the series of URLs and processes them
+            # Results have to be in the same order, so parents are given to the children
+            for i, (g, series_url) in enumerate(series_of_urls):
+                yield g, series_url, series_of_urls[i - 1] if i > 0 else None
+            series_of_urls.clear()
+            add_to_series = False
+        elif add_to_series:
+            series_of_urls.append((group, url))
+            downloaded_urls.add(url)
+        else:
+            yield group, url, None
+            downloaded_urls.add(url)
+
+
+def canonical_url(manager: DownloaderManager, url: str) -> str:
+    try:
+        return manager.determine_downloader(url).canonical_url()
+    except (NotImplementedError, ImageDownloaderException):
+        return url
+
+
+def schedule_url_jobs(urls: list, manager: DownloaderManager, scheduler):
+    """Yields jobs from iter_url_jobs with canonical parent URLs, registering series dependencies with scheduler"""
+    for group, url, parent in iter_url_jobs(urls):
+        if parent:
+            parent = (parent[0], canonical_url(manager, parent[1]))
+            scheduler.add_dependency(canonical_url(manager, url), parent[1])
+        yield group, url, parent
+
+
+def plan_url_jobs(urls: list, manager: DownloaderManager, scheduler, redownload=False):
+    """
+    Returns (jobs, known) for the URL list, where known are error results for posts already in the database.
+    Known posts are looked up in batches by their canonical URL, before any request is made.
+    """
+    jobs = list(schedule_url_jobs(urls, manager, scheduler))
+    if redownload:
+        return jobs, []
+
+    links = [canonical_url(manager, url) for _, url, _ in jobs]
+    existing = find_original_links(links)
+    new_jobs = []
+    known = []
+    for job, link in zip(jobs, links):
+        if link in existing:
+            known.append(('Image {} already exists'.format(link), link))
+        else:
+            new_jobs.append(job)
+    return new_jobs, known
+
+
+class SeriesScheduler:
+    """
+    Orders results of an image series, as a child can only be saved after its parent.
+    Children are held back until their parent is resolved and are failed along with it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # parent URL -> child URLs
+        self.children = {}
+        # parent URL -> whether the parent can be linked to
+        self.resolved = {}
+        # parent URL -> ImageInfos waiting for it
+        self.waiting = {}
+
+    def add_dependency(self, child_url: str, parent_url: str):
+        with self.lock:
+            self.children.setdefault(parent_url, set()).add(child_url)
+
+    def resolve(self, result) -> list:
+        """
+        Takes a finished download (ImageInfo or error tuple) and returns list of (result, error) that are
+        ready to be passed on, in order.
+        """
+        ready = []
+        with self.lock:
+            self._resolve(result, ready)
+        return ready
+
+    def unresolved(self) -> list:
+        """Fails every image still waiting for a parent, returns list of (result, error)"""
+        ready = []
+        with self.lock:
+            for parent_url, children in self.waiting.items():
+                for child in children:
+                    discard_file(child)
+                    ready.append(('{}: Parent {} of {} was never processed'.format(
+                        child.downloader, parent_url, child.original_link), True))
+            self.waiting.clear()
+        return ready
+
+    def _resolve(self, result, ready: list):
+        if type(result) == ImageInfo:
+            if result.parent:
+                parent_ok = self.resolved.get(result.parent[1])
+                if parent_ok is None:
+                    self.waiting.setdefault(result.parent[1], []).append(result)
+                    return
+                elif not parent_ok:
+                    self._fail(result, ready)
+                    return self._release(result.original_link, False, ready)
+            ready.append((result, False))
+            self._release(result.original_link, True, ready)
+        else:
+            message, url = result
+            ready.append((message, True))
+            # Parent that already exists in the database can still be linked to
+            self._release(url, url in self.children and parent_exists(url), ready)
+
+    def _fail(self, img_info: ImageInfo, ready: list):
+        discard_file(img_info)
+        ready.append(('{}: Skipped {}, parent {} failed'.format(
+            img_info.downloader, img_info.original_link, img_info.parent[1]), True))
+
+    def _release(self, url: str, ok: bool, ready: list):
+        """Passes on the children waiting for url, and theirs in turn, without recursing down long series"""
+        released = deque([(url, ok)])
+        while released:
+            url, ok = released.popleft()
+            if url not in self.children:
+                continue
+            self.resolved[url] = ok
+            for child in self.waiting.pop(url, []):
+                if ok:
+                    ready.append((child, False))
+                else:
+                    self._fail(child, ready)
+                released.append((child.original_link, ok))
+
+
+def parent_exists(url: str) -> bool:
+    return db.Image.select().where(db.Image.original_link == url).exists()
+
+
+def queue_consumer(queue: queue.Queue, url_count: int, results_callback, scheduler: SeriesScheduler):
     i = 0
-    resolved_urls = set()
 
     with progressbar.ProgressBar(max_value=url_count, initial_value=0, redirect_stdout=True) as bar:
         bar.update(i)
+
+        def handle(ready):
+            nonlocal i
+            for result, error in ready:
+                # The consumer has to keep draining the queue, or the workers putting into it block for good
+                try:
+                    if error:
+                        results_callback(result, error=True)
+                    else:
+                        results_callback(result)
+                except Exception as e:
+                    print('Handling result {} failed: {!r}'.format(result if error else result.original_link, e))
+                i += 1
+                bar.update(min(i, url_count))
+
         while True:
             finished = queue.get()
-            if type(finished) == ImageInfo:
-                # add back to queue if the image has a parent but it isn't processed yet
-                if finished.parent and finished.parent[1] not in resolved_urls:
-                    queue.task_done()
-                    queue.put(finished)
-                    continue
-                results_callback(finished)
-                resolved_urls.add(finished.original_link)
-            elif type(finished) == tuple:
-                results_callback(finished[0], error=True)
-                resolved_urls.add(finished[1])
-            else:
-                queue.task_done()
+            if finished is None:
                 break
-
-            queue.task_done()
-            bar.update(i)
-            i += 1
+            try:
+                ready = scheduler.resolve(finished)
+            except Exception as e:
+                ready = [('Ordering result {} failed: {!r}'.format(finished, e), True)]
+            handle(ready)
+        handle(scheduler.unresolved())
 
 
 def get_image_bulk(urls: list, results_callback, **kwargs):
+    """
+    Downloads images in a pipeline of bounded queues: metadata workers -> data workers -> results_callback.
+    Results are handled as soon as they finish and a slow callback holds back the downloads.
+    Posts are upvoted in the background unless upvote is False, all upvotes are sent by the time this returns.
+    """
     url_count = sum(1 for _, url in urls if url.startswith('http'))
-
-    image_queue = queue.Queue(0)
-    consumer = threading.Thread(target=queue_consumer, args=(image_queue, url_count, results_callback))
+    download_config = config.get('download', {})
+    workers = download_config.get('workers', 3)
+    queue_size = download_config.get('queue_size', workers * 4)
+
+    job_queue = queue.Queue(queue_size)
+    data_queue = queue.Queue(queue_size)
+    image_queue = queue.Queue(queue_size)
+    scheduler = SeriesScheduler()
+    consumer = threading.Thread(target=queue_consumer, args=(image_queue, url_count, results_callback, scheduler))
     consumer.start()
 
     manager = DownloaderManager()
+    skip_data = kwargs.pop('skip_data', False)
+    upvotes = UpvoteQueue() if kwargs.pop('upvote', True) else None
 
-    def download_image(group, url, parent=None):
-        downloader = manager.determine_downloader(url)
-        return get_image(downloader, group, parent=parent, **kwargs)
-
-    futures = []
-    with confut.ThreadPoolExecutor(max_workers=3) as executor:
-        def download_image_series(series_urls):
-            # Results have to be in the same order, so we have to process them sequentially
-            for i, (g, url) in enumerate(series_urls):
-                parent = series_urls[i - 1] if i > 0 else None
-                futures.append(executor.submit(download_image, g, url, parent=parent))
-
-        downloaded_urls = set()
-        series_of_urls = []
-        add_to_series = False
-        for group, url in urls:
-            url = url.strip()
-            if url in downloaded_urls:
-                continue
-            if url == 'series':
-                # start of a series of URLs, process separately
-                add_to_series = True
-            elif url == 'end series':
-                # ends the series of URLs and processes them
-                if series_of_urls:
-                    download_image_series(series_of_urls)
-                    series_of_urls.clear()
-                add_to_series = False
-            elif add_to_series:
-                series_of_urls.append((group, url))
-                downloaded_urls.add(url)
+    def metadata_worker():
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            group, url, parent = job
+            try:
+                downloader = manager.determine_downloader(url)
+                img_info = get_image_metadata(downloader, group, parent=parent, upvotes=upvotes)
+                if type(img_info) != tuple:
+                    img_info = name_image(img_info, **kwargs)
+            except (NotImplementedError, ImageDownloaderException) as e:
+                img_info = (str(e), url)
+            except Exception as e:
+                # Unexpected page contents and the like fail only this URL, a dead worker would stall the queues
+                img_info = ('Getting metadata for {} failed: {!r}'.format(url, e), canonical_url(manager, url))
+
+            if type(img_info) == tuple or skip_data:
+                image_queue.put(img_info)
             else:
-                futures.append(executor.submit(download_image, group, url))
-                downloaded_urls.add(url)
+                data_queue.put(img_info)
 
-    for future in confut.as_completed(futures):
-        image = future.result()
-        image_queue.put(image)
+    def data_worker():
+        while True:
+            img_info = data_queue.get()
+            if img_info is None:
+                break
+            try:
+                result = get_image_data(img_info)
+            except Exception as e:
+                discard_file(img_info)
+                result = ('Downloading {} failed: {!r}'.format(img_info.link, e), img_info.original_link)
+            image_queue.put(result)
+
+    def start_workers(target):
+        threads = [threading.Thread(target=target) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def stop_workers(threads, worker_queue):
+        for _ in threads:
+            worker_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    metadata_threads = start_workers(metadata_worker)
+    data_threads = start_workers(data_worker)
 
-    image_queue.join()
-    image_queue.put(None)
-    consumer.join()
+    try:
+        jobs, known = plan_url_jobs(urls, manager, scheduler, redownload=kwargs.get('redownload', False))
+        for result in known:
+            image_queue.put(result)
+        # Metadata is prefetched a batch ahead of the jobs that need it, so workers get going after the first batch
+        for jobs_chunk in peewee.chunked(jobs, GelbooruAPIParser.batch_size):
+            manager.prefetch(url for _, url, _ in jobs_chunk)
+            for job in jobs_chunk:
+                job_queue.put(job)
+    finally:
+        # Workers and the consumer are always shut down, so an error here does not leave the process hanging
+        stop_workers(metadata_threads, job_queue)
+        stop_workers(data_threads, data_queue)
+        image_queue.put(None)
+        consumer.join()
+    if upvotes is not None:
+        upvotes.flush()
 
 
 def save_file(img_info: ImageInfo):
+    """Moves downloaded temporary file to its final name, should be called after the image is committed to DB"""
     dest_path = Path(config['groups'][img_info.group]) / img_info.filename
-    with dest_path.open('wb') as f:
-        f.write(img_info.data)
+    os.replace(img_info.path, dest_path)
+    img_info.path = None
 
 
-def process_tags(img: db.Image, tags: list):
+def save_redownloaded(img_info: ImageInfo):
+    """Replaces the file of an image that is already in DB, updating its size and content hash to the new file"""
+    db.Image.update(size=file_size(img_info), content_hash=img_info.content_hash) \
+        .where(db.Image.filename == img_info.filename) \
+        .execute()
+    save_file(img_info)
+
+
+def file_size(img_info: ImageInfo):
+    return os.path.getsize(img_info.path) if img_info.path else None
+
 
-    tags_query = db.Tag.select().where(db.Tag.tag << tags)
-    old_tags = set(tag.tag for tag in tags_query)
-    new_tags = set(tags) - old_tags
+def discard_file(img_info: ImageInfo):
+    if img_info.path:
+        try:
+            os.remove(img_info.path)
+        except FileNotFoundError:
+            pass
+        img_info.path = None
 
-    if len(new_tags) > 0:
-        db.Tag.insert_many({'tag': tag} for tag in new_tags).execute()
+
+def process_tags(img: db.Image, tags: list):
+    tag_ids = sorted(set(tag_cache.get_ids(tags).values()))
+    index = tag_index.get_index()
+    # The tag index keeps no copy of image tags, so the ones being replaced are read before they are deleted
+    old_tag_ids = get_image_tag_ids(img) if index is not None else ()
 
     def insert_tags(retries=5):
         if retries <= 0:
@@ -135,34 +390,52 @@ def process_tags(img: db.Image, tags: list):
             try:
                 db.ImageTag.delete().where(db.ImageTag.image == img).execute()
                 db.ImageTag.insert_many(
-                    {'image': img, 'tag': tag} for tag in tags_query) \
+                    {'image': img, 'tag': tag_id} for tag_id in tag_ids) \
                     .execute()
+                generation = db.bump_generation()
+                db.Image.update(generation=generation).where(db.Image.id == img.id).execute()
             except peewee.OperationalError:
                 transaction.rollback()
                 return insert_tags(retries - 1)
     insert_tags()
 
+    if index is not None:
+        index.set_image_tags(img.id, img.group_id, tag_ids, old_tag_ids)
+
 
 def save(img_info: ImageInfo, retries=3):
     if not img_info:
         return
     elif retries <= 0:
         print('{}: No more retries for {}.'.format(img_info.downloader, img_info.original_link))
+        discard_file(img_info)
+        return
+
+    duplicate_of = find_content_hashes([img_info.content_hash]) if img_info.content_hash else {}
+    if duplicate_of:
+        print('{}: {} is the same file as {}'.format(
+            img_info.downloader, img_info.original_link, duplicate_of[img_info.content_hash]))
+        discard_file(img_info)
         return
 
     try:
         group = find_group(img_info.group)
         parent = None
         if img_info.parent:
-            parent = db.Image.get(db.Image.original_link == img_info.parent[1])
-        img = db.Image.create(
-            group=group,
-            filename=img_info.filename,
-            original_link=img_info.original_link,
-            parent=parent
-        )
+            parent = db.Image.get_or_none(db.Image.original_link == img_info.parent[1])
+        with db.db.atomic():
+            img = db.Image.create(
+                group=group,
+                filename=img_info.filename,
+                original_link=img_info.original_link,
+                content_hash=img_info.content_hash,
+                size=file_size(img_info),
+                parent=parent,
+                generation=db.bump_generation()
+            )
     except (peewee.IntegrityError, peewee.sqlite3.IntegrityError):
         print('{}: This {} is duplicated'.format(img_info.downloader, img_info.filename))
+        discard_file(img_info)
         return
     except peewee.OperationalError:
         print('Disk error, retrying...')
@@ -174,17 +447,208 @@ def save(img_info: ImageInfo, retries=3):
     print('{}: Image {} saved.'.format(img_info.downloader, img_info.original_link))
 
 
+class BatchWriter:
+    """
+    Saves finished images in batches, one transaction per batch.
+    Meant to be the results callback of get_image_bulk, so all database writes happen on the consumer thread.
+    """
+    def __init__(self, batch_size=None, max_delay=None):
+        database_config = config['database']
+        self.batch_size = batch_size or database_config.get('batch_size', 100)
+        self.max_delay = max_delay or database_config.get('batch_delay', 30)
+        self.batch = []
+        self.batch_started = None
+        self.group_ids = {}
+
+    def __call__(self, result, error=False):
+        if error:
+            print(result)
+            return
+        if not self.batch:
+            self.batch_started = time.monotonic()
+        self.batch.append(result)
+        if len(self.batch) >= self.batch_size or time.monotonic() - self.batch_started >= self.max_delay:
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def flush(self, retries=3):
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+
+        batch = self._skip_duplicates(batch)
+        new_tag_ids = {}
+        try:
+            with db.db.atomic():
+                tag_ids = self._insert(batch, new_tag_ids, db.bump_generation())
+        except (peewee.IntegrityError, peewee.sqlite3.IntegrityError):
+            # Another writer got in between, let save sort out the duplicates one by one
+            for img_info in batch:
+                save(img_info)
+            return
+        except peewee.OperationalError:
+            if retries <= 0:
+                for img_info in batch:
+                    print('{}: No more retries for {}.'.format(img_info.downloader, img_info.original_link))
+                    discard_file(img_info)
+                return
+            print('Disk error, retrying...')
+            self.batch = batch + self.batch
+            return self.flush(retries - 1)
+
+        tag_cache.add(new_tag_ids)
+        index = tag_index.get_index()
+        for img_info in batch:
+            if index is not None:
+                index.set_image_tags(img_info.id, self.group_ids[img_info.group], tag_ids[img_info.id])
+            save_file(img_info)
+            print('{}: Image {} saved.'.format(img_info.downloader, img_info.original_link))
+
+    def _skip_duplicates(self, batch: list) -> list:
+        filenames = set()
+        for filenames_chunk in peewee.chunked([img_info.filename for img_info in batch], MAX_QUERY_PARAMS):
+            query = db.Image.select(db.Image.filename).where(db.Image.filename << filenames_chunk).tuples()
+            filenames.update(filename for (filename,) in query)
+
+        # Same file under another name, possibly from another site or group
+        duplicate_of = find_content_hashes(img_info.content_hash for img_info in batch if img_info.content_hash)
+
+        unique = []
+        for img_info in batch:
+            if img_info.filename in filenames:
+                print('{}: This {} is duplicated'.format(img_info.downloader, img_info.filename))
+                discard_file(img_info)
+            elif img_info.content_hash in duplicate_of:
+                print('{}: {} is the same file as {}'.format(
+                    img_info.downloader, img_info.original_link, duplicate_of[img_info.content_hash]))
+                discard_file(img_info)
+            elif img_info.group not in self.group_ids and not self._cache_group(img_info.group):
+                print('{}: No such image group {}'.format(img_info.downloader, img_info.group))
+                discard_file(img_info)
+            else:
+                filenames.add(img_info.filename)
+                if img_info.content_hash:
+                    duplicate_of[img_info.content_hash] = img_info.filename
+                unique.append(img_info)
+        return unique
+
+    def _cache_group(self, name: str) -> bool:
+        group = db.ImageGroup.get_or_none(db.ImageGroup.name == name)
+        if group is None:
+            return False
+        self.group_ids[name] = group.id
+        return True
+
+    def _insert(self, batch: list, new_tag_ids: dict, generation: int) -> dict:
+        """
+        Inserts images with their tags and sets img_info.id, returns dictionary of image ID to tag IDs.
+        Tag IDs looked up in the transaction are put in new_tag_ids, to be cached after it commits.
+        """
+        image_ids = {}
+        for chunk in peewee.chunked(batch, MAX_QUERY_PARAMS // 4):
+            db.Image.insert_many({
+                'group': self.group_ids[img_info.group],
+                'filename': img_info.filename,
+                'original_link': img_info.original_link,
+                'content_hash': img_info.content_hash,
+                'size': file_size(img_info),
+                'generation': generation
+            } for img_info in chunk).execute()
+            query = db.Image.select(db.Image.id, db.Image.filename) \
+                .where(db.Image.filename << [img_info.filename for img_info in chunk]) \
+                .tuples()
+            image_ids.update((filename, image_id) for image_id, filename in query)
+
+        link_ids = {}
+        for img_info in batch:
+            img_info.id = image_ids[img_info.filename]
+            link_ids[img_info.original_link] = img_info.id
+
+        parent_links = set(img_info.parent[1] for img_info in batch if img_info.parent) - set(link_ids)
+        for links_chunk in peewee.chunked(parent_links, MAX_QUERY_PARAMS):
+            query = db.Image.select(db.Image.id, db.Image.original_link) \
+                .where(db.Image.original_link << links_chunk) \
+                .tuples()
+            link_ids.update((link, image_id) for image_id, link in query)
+        for img_info in batch:
+            if img_info.parent and img_info.parent[1] in link_ids:
+                db.Image.update(parent=link_ids[img_info.parent[1]]).where(db.Image.id == img_info.id).execute()
+
+        tag_ids = tag_cache.get_ids(set(tag for img_info in batch for tag in img_info.tags), pending=new_tag_ids)
+        image_tags = {img_info.id: sorted(set(tag_ids[tag] for tag in img_info.tags)) for img_info in batch}
+        rows = [{'image': image_id, 'tag': tag_id} for image_id, tags in image_tags.items() for tag_id in tags]
+        for chunk in peewee.chunked(rows, MAX_QUERY_PARAMS // 2):
+            db.ImageTag.insert_many(chunk).execute()
+        return image_tags
+
+
+def backfill_hashes(group: db.ImageGroup=None, batch_size=None):
+    """Hashes files of images that do not have a content hash or size yet, files are read in parallel processes"""
+    query = db.Image.select(db.Image.id, db.Image.filename, db.ImageGroup.name) \
+        .join(db.ImageGroup) \
+        .where(db.Image.content_hash.is_null() | db.Image.size.is_null())
+    if group:
+        query = query.where(db.Image.group == group)
+    images = [(image_id, os.path.join(config['groups'][group_name], filename))
+        for image_id, filename, group_name in query.tuples() if group_name in config['groups']]
+    batch_size = batch_size or config['database'].get('batch_size', 100)
+
+    hashed = 0
+    missing = []
+    with ProcessPoolExecutor() as executor, \
+            progressbar.ProgressBar(max_value=len(images), initial_value=0, redirect_stdout=True) as bar:
+        hashes = executor.map(util.hash_file, [path for _, path in images], chunksize=32)
+        for i, chunk in enumerate(peewee.chunked(zip(images, hashes), batch_size)):
+            with db.db.atomic():
+                for (image_id, path), content_hash in chunk:
+                    if content_hash is None:
+                        missing.append(path)
+                        continue
+                    db.Image.update(content_hash=content_hash, size=os.path.getsize(path)) \
+                        .where(db.Image.id == image_id) \
+                        .execute()
+                    hashed += 1
+            bar.update(min((i + 1) * batch_size, len(images)))
+
+    for path in missing:
+        print('File {} does not exist'.format(path))
+    duplicates = db.Image.select(db.Image.content_hash) \
+        .where(db.Image.content_hash.is_null(False)) \
+        .group_by(db.Image.content_hash) \
+        .having(peewee.fn.COUNT(db.Image.id) > 1) \
+        .count()
+    print('Hashed {} images, {} files missing, {} files are saved more than once.'.format(hashed, len(missing), duplicates))
+
+
+def build_thumbnails(group: db.ImageGroup=None):
+    """Generates missing gallery thumbnails for all images or images of group"""
+    import thumbnails
+
+    query = db.Image.select(db.Image.filename, db.Image.content_hash, db.ImageGroup.name).join(db.ImageGroup)
+    if group:
+        query = query.where(db.Image.group == group)
+    sources = [(os.path.join(config['groups'][group_name], filename), content_hash)
+        for filename, content_hash, group_name in query.tuples() if group_name in config['groups']]
+    made = thumbnails.generate_thumbnails(sources)
+    print('Made {} thumbnails for {} images.'.format(made, len(sources)))
+
+
 def fetch_image_urls(group: db.ImageGroup, all_images: bool):
-    query = db.Image.select(db.Image.original_link, db.Image.filename).join(db.ImageGroup)
+    """Returns (group, original link) of images in group or all groups, only ones missing a file unless all_images"""
+    query = db.Image.select(db.ImageGroup.name, db.Image.original_link, db.Image.filename) \
+        .join(db.ImageGroup) \
+        .tuples()
     if group:
         query = query.where(db.Image.group == group)
     if all_images:
-        return [(img.group.name, img.original_link) for img in query]
+        return [(group_name, link) for group_name, link, _ in query.iterator()]
 
-    if group:
-        files = set(file.name for file in Path(config['groups'][group.name]).iterdir())
-    else:
-        files = set()
-        for g in get_groups():
-            files = files.intersection(file.name for file in Path(config['groups'][g.name]).iterdir())
-    return [(img.group.name, img.original_link) for img in query if img.filename not in files]
+    groups = [group] if group else get_groups()
+    files = fs_index.scan_groups({g.name: config['groups'][g.name] for g in groups if g.name in config['groups']})
+    return [(group_name, link) for group_name, link, filename in query.iterator()
+        if filename not in files.get(group_name, ())]
@@ -0,0 +1,187 @@
+"""
+On-disk thumbnail cache for the gallery.
+Thumbnails are content addressed, so the same file saved under several names or moved between groups shares one
+thumbnail. The cache is kept under a size limit by evicting the least recently read thumbnails. Reads are recorded by
+setting access times explicitly, as filesystems mounted with noatime or relatime do not keep them up to date.
+"""
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+
+import progressbar
+
+from concurrent.futures import ProcessPoolExecutor
+
+from imagedb.config import load_config
+
+__author__ = 'Chronoes'
+
+config = load_config()
+thumbnail_config = config.get('thumbnails', {})
+
+CACHE_PATH = thumbnail_config.get('path') or os.path.join(os.path.dirname(__file__), 'cache', 'thumbnails')
+SIZE = thumbnail_config.get('size', 320)
+QUALITY = thumbnail_config.get('quality', 85)
+MAX_CACHE_SIZE = thumbnail_config.get('max_size_mb', 1024) * 1024 * 1024
+# Eviction goes a bit below the limit, so it does not run again on the next thumbnail
+EVICT_TO = 0.9
+# Access time of a thumbnail is recorded at most this often, so serving it does not mean a metadata write every time
+TOUCH_INTERVAL = 60 * 60
+
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mkv', '.mov', '.avi')
+
+
+def thumbnail_key(source: str, content_hash=None) -> str:
+    """Cache key of a file, files without content hash are keyed by path, size and modification time"""
+    if content_hash:
+        return content_hash
+    stat = os.stat(source)
+    return hashlib.sha256('{}:{}:{}'.format(os.path.abspath(source), stat.st_size, stat.st_mtime_ns).encode()).hexdigest()
+
+
+def thumbnail_path(key: str) -> str:
+    return os.path.join(CACHE_PATH, key[:2], key + '.jpg')
+
+
+def _video_frame(source: str):
+    """Returns first frame of video as PNG bytes, None if ffmpeg is not available"""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        return None
+    result = subprocess.run(
+        [ffmpeg, '-v', 'error', '-i', source, '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60)
+    return result.stdout or None
+
+
+def make_thumbnail(source: str, dest: str) -> bool:
+    """Writes JPEG thumbnail of image or video source to dest, returns False if it cannot be made"""
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        if source.lower().endswith(VIDEO_EXTENSIONS):
+            frame = _video_frame(source)
+            if frame is None:
+                return False
+            image = Image.open(io.BytesIO(frame))
+        else:
+            image = Image.open(source)
+        # Only the first frame of animations, decoded at a reduced size where the format allows it
+        image.draft('RGB', (SIZE, SIZE))
+        image.thumbnail((SIZE, SIZE))
+        image = image.convert('RGB')
+    except (OSError, UnidentifiedImageError, subprocess.SubprocessError):
+        return False
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    temp_path = '{}.{}.part'.format(dest, uuid.uuid4().hex)
+    try:
+        with open(temp_path, 'xb') as f:
+            image.save(f, 'JPEG', quality=QUALITY)
+        os.replace(temp_path, dest)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return True
+
+
+class CacheSize:
+    """Approximate size of the cache directory, counted once and then kept up to date by this process"""
+    def __init__(self):
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _scan(self):
+        return [entry for directory in os.scandir(CACHE_PATH) if directory.is_dir()
+            for entry in os.scandir(directory.path) if entry.name.endswith('.jpg')]
+
+    def add(self, size: int):
+        with self.lock:
+            if self.size is None:
+                os.makedirs(CACHE_PATH, exist_ok=True)
+                self.size = sum(entry.stat().st_size for entry in self._scan())
+            else:
+                self.size += size
+            if self.size > MAX_CACHE_SIZE:
+                self.size = self._evict()
+
+    def _evict(self) -> int:
+        """Removes least recently used thumbnails until the cache is under the limit, returns the new size"""
+        entries = sorted(((entry.stat(), entry.path) for entry in self._scan()), key=lambda e: e[0].st_atime)
+        size = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if size <= MAX_CACHE_SIZE * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= stat.st_size
+        return size
+
+
+cache_size = CacheSize()
+
+
+def touch(path: str) -> bool:
+    """
+    Records a read of the thumbnail for eviction, returns False if it does not exist.
+    Only the access time is set, modification time stays as it is used for the HTTP validators.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    now = time.time_ns()
+    if now - stat.st_atime_ns > TOUCH_INTERVAL * 10 ** 9:
+        try:
+            os.utime(path, ns=(now, stat.st_mtime_ns))
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def get_thumbnail(source: str, content_hash=None):
+    """Returns path of thumbnail for source, generating it if needed, None if the thumbnail cannot be made"""
+    try:
+        path = thumbnail_path(thumbnail_key(source, content_hash))
+    except FileNotFoundError:
+        return None
+
+    if touch(path):
+        return path
+    if not make_thumbnail(source, path):
+        return None
+    cache_size.add(os.path.getsize(path))
+    return path
+
+
+def generate_thumbnails(sources: list, workers=None):
+    """Generates missing thumbnails for list of (source, content hash) in a process pool, returns number made"""
+    jobs = []
+    for source, content_hash in sources:
+        try:
+            path = thumbnail_path(thumbnail_key(source, content_hash))
+        except FileNotFoundError:
+            continue
+        if not os.path.exists(path):
+            jobs.append((source, path))
+
+    made = 0
+    with ProcessPoolExecutor(workers) as executor, \
+            progressbar.ProgressBar(max_value=len(jobs), initial_value=0, redirect_stdout=True) as bar:
+        results = executor.map(make_thumbnail, [source for source, _ in jobs], [path for _, path in jobs],
+            chunksize=8)
+        for i, ((source, path), ok) in enumerate(zip(jobs, results), 1):
+            if ok:
+                made += 1
+                cache_size.add(os.path.getsize(path))
+            else:
+                print('Could not make thumbnail of {}'.format(source))
+            bar.update(i)
+    return made
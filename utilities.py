@@ -1,3 +1,4 @@
+import hashlib
 import shutil
 import sys
 import functools
@@ -12,6 +13,18 @@ def parse_extension(link: str) -> str:
     return '.' + parse_filename(link).split('.')[-1]
 
 
+def hash_file(path, chunk_size=1024 * 1024):
+    """Returns SHA-256 of the file as hex, None if the file does not exist"""
+    content_hash = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                content_hash.update(chunk)
+    except FileNotFoundError:
+        return None
+    return content_hash.hexdigest()
+
+
 def progress_bar(iteration, total, prefix='', suffix=''):
     """
     Call in a loop to create terminal progress bar